@@ -0,0 +1,31 @@
+"""
+gunicorn settings for running several uvicorn workers:
+
+    gunicorn -c gunicorn.conf.py main:app
+
+Prometheus multiprocess mode needs a directory shared by all workers; it is wiped when the
+master starts, and a dead worker's live gauges are dropped so the WebSocket count stays right.
+"""
+import os
+import shutil
+
+# prometheus_client picks its value class when it is first imported, so this has to be set
+# before anything imports it; forked workers inherit it from the master
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/chatbot-prometheus")
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def on_starting(server):
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # Imported here, not at the top, so the master never loads prometheus_client early
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
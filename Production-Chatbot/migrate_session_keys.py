@@ -0,0 +1,60 @@
+"""
+Moves sessions stored under key schema version 1 (user:<id>, user:<id>:<session_id>, ...) to the
+hash-tagged layout (user:{<id>}, ...; see SESSION_SCHEMA_VERSION in main.py), then records the
+schema version in Redis so workers stop checking for version 1 keys after their next restart.
+
+Sessions are also moved on first use, so this only finishes the migration. It is safe to run
+while the service is up and to run again. Uses the Redis settings from the .env file:
+
+    python migrate_session_keys.py [--dry-run] [--scan-count 500]
+"""
+import argparse
+import asyncio
+import logging
+
+import main
+
+
+async def migrate(dry_run: bool, scan_count: int):
+    redis_client = main.redis_client
+    main.session_schema["legacy_check"] = True  # Regardless of SESSION_LEGACY_MIGRATION
+    counts = {"moved": 0, "stale": 0}
+    async for key in redis_client.scan_iter(match="user:*", count=scan_count):
+        user_id = main.legacy_pointer_user_id(key)
+        if user_id is None:
+            continue
+        session_id = await redis_client.hget(key, "session_id")
+        # A pointer whose session already expired, or a user who already has a version 2
+        # session, has nothing worth moving
+        live = session_id and await redis_client.exists(f"{key}:{session_id}")
+        if not live or await redis_client.exists(main.user_key(user_id)):
+            counts["stale"] += 1
+            if not dry_run:
+                await main.end_legacy_session(user_id)
+            continue
+        counts["moved"] += 1
+        if not dry_run:
+            user_name = await redis_client.hget(f"{key}:{session_id}", "user_name") or ""
+            await main.get_or_create_session(user_id, user_name, load_history=False)
+    if not dry_run:
+        await redis_client.set(main.SESSION_SCHEMA_MARKER_KEY, main.SESSION_SCHEMA_VERSION)
+    return counts
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="only count the sessions to move")
+    parser.add_argument("--scan-count", type=int, default=500, help="SCAN batch size per node")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    counts = asyncio.run(migrate(args.dry_run, args.scan_count))
+    action = "would move" if args.dry_run else "moved"
+    print(f"{action} {counts['moved']} sessions, {counts['stale']} stale version 1 pointers "
+          f"{'found' if args.dry_run else 'deleted'}")
+    if not args.dry_run:
+        print(f"session schema marker set to version {main.SESSION_SCHEMA_VERSION}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,183 @@
+"""
+Lightweight request tracing: nested spans per pipeline stage, exported one trace at a time.
+
+    with tracer.span("chat.message", user_id=user_id) as span:
+        ...
+        span.set(output_tokens=n)
+
+The current span lives in a contextvar, so spans opened in tasks created by asyncio.gather or
+create_task nest under the span that was open when the task was created. A trace is kept when
+the root span is head-sampled (TRACE_SAMPLE_RATE) or when it ran longer than TRACE_SLOW_MS, so
+slow requests are captured even at a low sample rate.
+
+Exporters receive a list of span dicts for one finished trace:
+    TRACE_EXPORTER=none          tracing off (default)
+    TRACE_EXPORTER=jsonl         one JSON line per span in TRACE_FILE, for offline analysis
+    TRACE_EXPORTER=log           one summary log line per trace
+    TRACE_EXPORTER=pkg.mod:func  func() returns an object with an export(spans) method
+"""
+import contextvars
+import importlib
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "events", "start",
+                 "duration_ms", "status")
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.events = []
+        self.start = time.time()
+        self.duration_ms = None
+        self.status = "ok"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def event(self, name, **attributes):
+        self.events.append({"name": name, "at_ms": round((time.time() - self.start) * 1000, 1), **attributes})
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attributes": self.attributes,
+            "events": self.events,
+        }
+
+
+class _Trace:
+    __slots__ = ("trace_id", "sampled", "spans")
+
+    def __init__(self, sampled):
+        self.trace_id = uuid.uuid4().hex
+        self.sampled = sampled
+        self.spans = []
+
+
+class _NoopSpan:
+    """Stands in for a span when tracing is off, so call sites never need to check."""
+
+    def set(self, **attributes):
+        pass
+
+    def event(self, name, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class JsonlExporter:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        # One write per trace; sampled traces are small enough to append inline
+        # Attributes can hold any value a call site passed, so encode leniently
+        lines = "".join(dumps(span, lenient=True) + "\n" for span in spans)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+
+class LogExporter:
+    def export(self, spans):
+        root = spans[-1]
+        stages = ", ".join(f"{s['name']}={s['duration_ms']}" for s in spans[:-1])
+        logger.info(f"trace {root['trace_id']} {root['name']} {root['duration_ms']} ms "
+                    f"[{root['status']}] {root['attributes']} stages(ms): {stages}")
+
+
+class Tracer:
+    def __init__(self, exporter=None, sample_rate=0.0, slow_ms=0.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.stats = {"traces": 0, "exported": 0, "export_errors": 0}
+
+    @contextmanager
+    def span(self, name, **attributes):
+        if self.exporter is None:
+            yield NOOP_SPAN
+            return
+        parent = _current_span.get()
+        if parent is None:
+            self.stats["traces"] += 1
+            trace = _Trace(sampled=random.random() < self.sample_rate)
+        else:
+            trace = parent.trace
+        span = Span(trace, name, parent.span_id if parent else None, attributes)
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error" if isinstance(e, Exception) else "cancelled"
+            if isinstance(e, Exception):
+                span.attributes["error"] = str(e)
+            raise
+        finally:
+            span.duration_ms = round((time.perf_counter() - start) * 1000, 1)
+            _current_span.reset(token)
+            trace.spans.append(span)
+            if parent is None:
+                self._finish(trace, span)
+
+    def _finish(self, trace, root):
+        if not (trace.sampled or (self.slow_ms and root.duration_ms >= self.slow_ms)):
+            return
+        root.attributes["sampled"] = "head" if trace.sampled else "slow"
+        try:
+            self.exporter.export([span.to_dict() for span in trace.spans])
+            self.stats["exported"] += 1
+        except Exception as e:
+            self.stats["export_errors"] += 1
+            logger.warning(f"Trace export failed: {e}")
+
+
+def current_span():
+    """The innermost open span, or a no-op span outside of any trace."""
+    return _current_span.get() or NOOP_SPAN
+
+
+def build_exporter(name: str):
+    if not name or name == "none":
+        return None
+    if name == "jsonl":
+        return JsonlExporter(os.getenv("TRACE_FILE", "traces.jsonl"))
+    if name == "log":
+        return LogExporter()
+    module_name, _, factory = name.partition(":")
+    return getattr(importlib.import_module(module_name), factory)()
+
+
+def tracer_from_env():
+    """Builds the tracer from TRACE_* settings; call after the .env file has been loaded."""
+    return Tracer(
+        exporter=build_exporter(os.getenv("TRACE_EXPORTER", "none")),
+        sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "0.05")),
+        slow_ms=float(os.getenv("TRACE_SLOW_MS", "0")),
+    )
@@ -1,17 +1,30 @@
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Header, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import os
 import httpx
-import json
 import asyncio
 from dotenv import load_dotenv
 import uuid
+import hashlib
+import random
+import re
+import string
+import time
 import anthropic
 from pydantic import BaseModel
+from redis.asyncio import Redis
 from redis.asyncio.cluster import RedisCluster
 from redis.cluster import ClusterNode
 import logging
-from openai import OpenAI
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from openai import AsyncOpenAI
+from serialization import dumps, loads, JSONDecodeError, FrameTemplate, frame
+from metrics import (
+    ACTIVE_WEBSOCKETS, LLM_FALLBACKS, LLM_STREAMS, LLM_TIME_TO_FIRST_TOKEN, LLM_TOKENS_PER_SECOND,
+    REDIS_LATENCY, UPSTREAM_LATENCY, render_metrics, timed,
+)
+from tracing import current_span, tracer_from_env
 
 
 class StartSessionRequest(BaseModel):
@@ -24,6 +37,15 @@ class EndSessionRequest(BaseModel):
     user_id: str
 
 
+class InvalidateProfileRequest(BaseModel):
+    user_id: str
+
+
+class PushMessageRequest(BaseModel):
+    user_id: str
+    data: object  # delivered as the `data` of a `push` frame
+
+
 # Initialize logging
 logging.basicConfig(level=logging.INFO)  # Replace DEBUG with INFO or WARNING
 logger = logging.getLogger(__name__)
@@ -31,26 +53,59 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# Spans per pipeline stage; off unless TRACE_EXPORTER is set (see tracing.py)
+tracer = tracer_from_env()
+
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Process-wide resources are opened once per worker and torn down on shutdown
+    await init_http_client()
+    await load_session_schema_marker()
+    invalidation_listener = asyncio.create_task(cache_invalidation_listener())
+    breaker_sync = asyncio.create_task(provider_router.sync_loop())
+    delivery_listener = asyncio.create_task(manager.run_delivery_listener())
+    presence_refresh = asyncio.create_task(manager.run_presence_refresh())
+    try:
+        yield
+    finally:
+        invalidation_listener.cancel()
+        breaker_sync.cancel()
+        delivery_listener.cancel()
+        presence_refresh.cancel()
+        await close_http_client()
+
+
 # App Configuration
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 API_KEY = os.getenv('STAGING_API_KEY')
 
 
+_openai_client = None
+
+
 def get_openai_client():
-    api_key = os.getenv("STAGING_GROK_API_KEY")
-    base_url = os.getenv("STAGING_GROK_URL")
-    if not api_key:
-        raise ValueError("STAGING_GROK_API_KEY not found in environment variables")
-    client = OpenAI(
-        api_key=api_key,
-        base_url=base_url,
-    )
-    return client
+    # The async client owns a connection pool, so it is created once per process and reused.
+    global _openai_client
+    if _openai_client is None:
+        api_key = os.getenv("STAGING_GROK_API_KEY")
+        base_url = os.getenv("STAGING_GROK_URL")
+        if not api_key:
+            raise ValueError("STAGING_GROK_API_KEY not found in environment variables")
+        _openai_client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+        )
+    return _openai_client
 
 
+REDIS_HOST = os.getenv("REDIS_HOST", "ai-test-cache-56sm92.serverless.euw2.cache.amazonaws.com")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
 redis_client = RedisCluster(
-    startup_nodes=[ClusterNode("ai-test-cache-56sm92.serverless.euw2.cache.amazonaws.com", 6379)],
+    startup_nodes=[ClusterNode(REDIS_HOST, REDIS_PORT)],
     decode_responses=True,
     socket_timeout=5,
     socket_connect_timeout=5,
@@ -59,6 +114,333 @@ redis_client = RedisCluster(
     ssl=True, )
 
 
+# Shared HTTP client for upstream services (vector store, OpenSearch, ...).
+# Keep-alive pooling removes the TCP+TLS handshake from every chat turn.
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "200"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "50"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "15"))
+UPSTREAM_WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "10"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+
+_http_client = None
+
+
+def _build_http_client():
+    http2 = UPSTREAM_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401  (httpx needs the optional h2 package for HTTP/2)
+        except ImportError:
+            logger.warning("UPSTREAM_HTTP2 is enabled but the 'h2' package is not installed; using HTTP/1.1")
+            http2 = False
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            read=UPSTREAM_READ_TIMEOUT,
+            write=UPSTREAM_WRITE_TIMEOUT,
+            pool=UPSTREAM_POOL_TIMEOUT,
+        ),
+    )
+
+
+async def init_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = _build_http_client()
+        logger.info("Upstream HTTP client pool initialised.")
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def get_http_client():
+    # Lazily created when used outside the app lifespan (scripts, tests)
+    global _http_client
+    if _http_client is None:
+        _http_client = _build_http_client()
+    return _http_client
+
+
+async def timed_post(upstream: str, url: str, **kwargs):
+    """POSTs through the shared client, recording the latency per upstream and status code."""
+    start = time.perf_counter()
+    status = "error"
+    with tracer.span(f"http.{upstream}") as span:
+        try:
+            response = await get_http_client().post(url, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            span.set(status=status)
+            UPSTREAM_LATENCY.labels(upstream=upstream, status=status).observe(time.perf_counter() - start)
+
+
+def get_pubsub_connection():
+    # The async cluster client has no pub/sub support; a plain connection to the
+    # cluster endpoint receives PUBLISH messages from every node.
+    return Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True,
+                 socket_connect_timeout=5, health_check_interval=30)
+
+
+CACHE_INVALIDATION_CHANNEL = "cache-invalidate"
+CACHES = {}
+
+# Cross-worker coalescing: one worker loads a missing key while the others poll the Redis tier
+SINGLEFLIGHT_REDIS = os.getenv("SINGLEFLIGHT_REDIS", "false").lower() in ("1", "true", "yes")
+SINGLEFLIGHT_LEASE_MS = int(os.getenv("SINGLEFLIGHT_LEASE_MS", "3000"))
+SINGLEFLIGHT_POLL_INTERVAL = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL", "0.05"))
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key onto one in-flight task within this worker.
+    The shared task is shielded, so a caller that gives up (e.g. a stage deadline) does not
+    cancel the load for everyone else.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.stats = {"loads": 0, "coalesced": 0}
+
+    async def do(self, key, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats["loads"] += 1
+            task = asyncio.create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            # Retrieved here so an abandoned load does not log "exception was never retrieved"
+            logger.debug(f"Single-flight load for {key} failed: {task.exception()}")
+
+
+class TieredCache:
+    """
+    Two-tier cache: a per-process LRU with TTL in front of a shared Redis tier.
+    Entries older than `ttl` but younger than `stale_ttl` are served immediately
+    while a background task reloads them (stale-while-revalidate). Empty results are
+    only cached when `negative_ttl` is set, and only for that long, never stale.
+    """
+
+    def __init__(self, name: str, ttl: float, stale_ttl: float, local_max_size: int, negative_ttl: float = 0):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.negative_ttl = negative_ttl
+        self.local_max_size = local_max_size
+        self.local = OrderedDict()  # key -> (value, stored_at, negative)
+        self.stats = {
+            "local_hits": 0, "redis_hits": 0, "stale_hits": 0, "negative_hits": 0, "misses": 0,
+            "refreshes": 0, "invalidations": 0, "errors": 0,
+        }
+        self._refreshing = set()
+        self._tasks = set()
+        self.flight = SingleFlight()
+        self.flight.stats["coalesced_remote"] = 0
+        CACHES[name] = self
+
+    def _redis_key(self, key: str) -> str:
+        return f"cache:{self.name}:{key}"
+
+    def _local_get(self, key):
+        entry = self.local.get(key)
+        if entry is not None:
+            self.local.move_to_end(key)
+        return entry
+
+    def _local_set(self, key, value, stored_at, negative=False):
+        self.local[key] = (value, stored_at, negative)
+        self.local.move_to_end(key)
+        while len(self.local) > self.local_max_size:
+            self.local.popitem(last=False)
+
+    async def get(self, key: str, loader):
+        """Returns the cached value for `key`, calling `loader()` on a miss."""
+        now = time.time()
+        entry = self._local_get(key)
+        if entry is None:
+            try:
+                with timed(REDIS_LATENCY, operation="cache_get"):
+                    raw = await redis_client.get(self._redis_key(key))
+                if raw:
+                    payload = loads(raw)
+                    entry = (payload["v"], payload["t"], payload.get("n", False))
+                    self._local_set(key, *entry)
+                    tier = "redis_hits"
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"Cache '{self.name}' Redis read failed: {e}")
+        else:
+            tier = "local_hits"
+
+        if entry is not None:
+            value, stored_at, negative = entry
+            age = now - stored_at
+            if negative:
+                if age < self.negative_ttl:
+                    self.stats["negative_hits"] += 1
+                    return value
+            elif age < self.ttl:
+                self.stats[tier] += 1
+                return value
+            elif age < self.stale_ttl:
+                self.stats["stale_hits"] += 1
+                self._schedule_refresh(key, loader)
+                return value
+
+        self.stats["misses"] += 1
+        return await self._load(key, loader)
+
+    async def _load(self, key, loader):
+        # Concurrent misses and refreshes of one key share a single upstream call
+        return await self.flight.do(key, lambda: self._load_once(key, loader))
+
+    async def _load_once(self, key, loader):
+        lease_key = None
+        if SINGLEFLIGHT_REDIS:
+            lease_key = f"singleflight:{self.name}:{key}"
+            try:
+                is_leader = await redis_client.set(lease_key, "1", nx=True, px=SINGLEFLIGHT_LEASE_MS)
+            except Exception as e:
+                logger.warning(f"Cache '{self.name}' single-flight lease failed: {e}")
+                is_leader = True
+            if not is_leader:
+                lease_key = None
+                value = await self._wait_for_remote_fill(key)
+                if value is not None:
+                    self.flight.stats["coalesced_remote"] += 1
+                    return value
+        try:
+            return await self._fill(key, loader)
+        finally:
+            if lease_key:
+                await redis_client.delete(lease_key)
+
+    async def _wait_for_remote_fill(self, key):
+        # Another worker holds the lease; poll the Redis tier until it writes or the lease expires
+        deadline = time.monotonic() + SINGLEFLIGHT_LEASE_MS / 1000
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+            try:
+                raw = await redis_client.get(self._redis_key(key))
+            except Exception:
+                return None
+            if raw:
+                payload = loads(raw)
+                if time.time() - payload["t"] < SINGLEFLIGHT_LEASE_MS / 1000:
+                    self._local_set(key, payload["v"], payload["t"], payload.get("n", False))
+                    return payload["v"]
+        return None
+
+    async def _fill(self, key, loader):
+        value = await loader()
+        if value:
+            await self.set(key, value)
+        elif self.negative_ttl > 0:
+            await self.set(key, value, negative=True)
+        return value
+
+    async def set(self, key: str, value, negative: bool = False):
+        stored_at = time.time()
+        self._local_set(key, value, stored_at, negative)
+        try:
+            await redis_client.set(self._redis_key(key), dumps({"v": value, "t": stored_at, "n": negative}),
+                                   ex=max(1, int(self.negative_ttl if negative else self.stale_ttl)))
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Cache '{self.name}' Redis write failed: {e}")
+
+    def _schedule_refresh(self, key, loader):
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+
+        async def _refresh():
+            try:
+                await self._load(key, loader)
+                self.stats["refreshes"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"Cache '{self.name}' background refresh failed for {key}: {e}")
+            finally:
+                self._refreshing.discard(key)
+
+        task = asyncio.create_task(_refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def evict_local(self, key: str):
+        self.local.pop(key, None)
+
+    async def invalidate(self, key: str):
+        """Drops `key` from Redis and from the local tier of every worker."""
+        self.evict_local(key)
+        self.stats["invalidations"] += 1
+        await redis_client.delete(self._redis_key(key))
+        await redis_client.publish(CACHE_INVALIDATION_CHANNEL, dumps({"cache": self.name, "key": key}))
+
+
+async def cache_invalidation_listener():
+    """Evicts local cache entries invalidated by any worker; reconnects on failure."""
+    while True:
+        pubsub_conn = get_pubsub_connection()
+        try:
+            async with pubsub_conn.pubsub() as pubsub:
+                await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        payload = loads(message["data"])
+                        cache = CACHES.get(payload.get("cache"))
+                        if cache:
+                            cache.evict_local(payload.get("key"))
+                    except (JSONDecodeError, TypeError) as e:
+                        logger.warning(f"Ignoring malformed cache invalidation message: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Cache invalidation listener error: {e}; reconnecting in 5s")
+            await asyncio.sleep(5)
+        finally:
+            await pubsub_conn.aclose()
+
+
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+PROFILE_CACHE_STALE_TTL = float(os.getenv("PROFILE_CACHE_STALE_TTL", "3600"))
+PROFILE_CACHE_LOCAL_SIZE = int(os.getenv("PROFILE_CACHE_LOCAL_SIZE", "10000"))
+
+profile_cache = TieredCache("profile", PROFILE_CACHE_TTL, PROFILE_CACHE_STALE_TTL, PROFILE_CACHE_LOCAL_SIZE)
+
+VECTOR_CACHE_TTL = float(os.getenv("VECTOR_CACHE_TTL", "3600"))
+VECTOR_CACHE_STALE_TTL = float(os.getenv("VECTOR_CACHE_STALE_TTL", "21600"))
+VECTOR_CACHE_NEGATIVE_TTL = float(os.getenv("VECTOR_CACHE_NEGATIVE_TTL", "15"))
+VECTOR_CACHE_LOCAL_SIZE = int(os.getenv("VECTOR_CACHE_LOCAL_SIZE", "2000"))
+
+vector_cache = TieredCache("vector", VECTOR_CACHE_TTL, VECTOR_CACHE_STALE_TTL, VECTOR_CACHE_LOCAL_SIZE,
+                           negative_ttl=VECTOR_CACHE_NEGATIVE_TTL)
+
+
 async def safe_send_text(websocket: WebSocket, text_message: str) -> bool:
     try:
         await websocket.send_text(text_message)
@@ -73,7 +455,7 @@ async def safe_send_text(websocket: WebSocket, text_message: str) -> bool:
 
 async def safe_send_json(websocket: WebSocket, data: dict) -> bool:
     try:
-        await websocket.send_json(data)
+        await websocket.send_text(dumps(data))
     except WebSocketDisconnect:
         logger.warning("WebSocket disconnected while sending JSON.")
         return False
@@ -83,9 +465,80 @@ async def safe_send_json(websocket: WebSocket, data: dict) -> bool:
     return True
 
 
+# Flush policy for `streaming` frames: any of "bytes", "time", "sentence"; "none" sends every delta
+STREAM_FLUSH_POLICY = {p.strip() for p in os.getenv("STREAM_FLUSH_POLICY", "bytes,time,sentence").split(",")} - {"", "none"}
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "256"))
+STREAM_FLUSH_MS = float(os.getenv("STREAM_FLUSH_MS", "30"))
+_SENTENCE_END = re.compile(r"""(?:[.!?…][\"')\]]?|\n|</(?:p|li|h2|ul|div)>)\s*$""")
+
+stream_stats = {"deltas": 0, "frames": 0, "bytes": 0, "failovers": 0, "failovers_failed": 0, "started_at": time.time()}
+
+
+class StreamingFrameBuffer:
+    """
+    Coalesces provider deltas into fewer `streaming` frames. Buffered text is flushed once it
+    reaches STREAM_FLUSH_BYTES, once the oldest buffered delta is STREAM_FLUSH_MS old, or at a
+    sentence boundary, as selected by STREAM_FLUSH_POLICY. The frame format is unchanged.
+    """
+
+    def __init__(self, websocket, message_id=None):
+        self.websocket = websocket
+        self.message_id = message_id
+        self.open = True
+        self._parts = []
+        self._size = 0
+        self._timer = None
+        self._timer_task = None
+        self._send_lock = asyncio.Lock()
+
+    @property
+    def message_id(self):
+        return self._message_id
+
+    @message_id.setter
+    def message_id(self, message_id):
+        # The fixed part of every frame is encoded once per message
+        self._message_id = message_id
+        self._template = FrameTemplate("streaming", message_id)
+
+    async def add(self, text: str) -> bool:
+        """Buffers one delta; returns False once the socket is closed."""
+        stream_stats["deltas"] += 1
+        self._parts.append(text)
+        self._size += len(text.encode("utf-8"))  # STREAM_FLUSH_BYTES counts encoded bytes, not characters
+        if (not STREAM_FLUSH_POLICY
+                or ("bytes" in STREAM_FLUSH_POLICY and self._size >= STREAM_FLUSH_BYTES)
+                or ("sentence" in STREAM_FLUSH_POLICY and _SENTENCE_END.search(text))):
+            return await self.flush()
+        if "time" in STREAM_FLUSH_POLICY and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(STREAM_FLUSH_MS / 1000, self._on_timer)
+        return self.open
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> bool:
+        """Sends whatever is buffered as one frame. Call before sending message_stop."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._send_lock:
+            if not self._parts or not self.open:
+                return self.open
+            data = "".join(self._parts)
+            self._parts.clear()
+            self._size = 0
+            payload = self._template.render(data)
+            self.open = await safe_send_text(self.websocket, payload)
+            stream_stats["frames"] += 1
+            stream_stats["bytes"] += len(payload.encode("utf-8"))
+            return self.open
+
+
 def initialize_claude_client():
-    # Initialize the Anthropic client with the given location and project ID
-    client = anthropic.Anthropic(
+    # Async client so streaming never blocks the event loop; shared by every connection in the worker
+    client = anthropic.AsyncAnthropic(
         api_key=os.getenv('ANTHROPIC_STAGING_API_KEY'),
     )
     return client
@@ -103,167 +556,780 @@ async def validate_api_key(authorization: str = Header(...)):
     return token
 
 
-# vector search call with an async version
+VECTOR_STORE_URL = os.getenv("VECTOR_STORE_URL", "https://ai-foodhak.com/chromadb_vecstore")
+
+
+QUERY_STOPWORDS = frozenset({
+    "a", "an", "the", "is", "are", "am", "was", "were", "be", "been", "do", "does", "did",
+    "i", "me", "my", "we", "our", "you", "your", "it", "its", "this", "that", "these", "those",
+    "to", "of", "in", "on", "at", "for", "with", "about", "and", "or", "so", "if", "can", "could",
+    "should", "would", "will", "please", "there", "what", "which", "any", "some",
+})
+_QUERY_PUNCTUATION = str.maketrans({c: " " for c in string.punctuation})
+
+
+def normalize_query(query: str) -> str:
+    """Lower-cases, strips punctuation and stopwords and collapses whitespace, keeping word order."""
+    words = query.lower().translate(_QUERY_PUNCTUATION).split()
+    kept = [word for word in words if word not in QUERY_STOPWORDS]
+    return " ".join(kept or words)
+
+
 async def perform_vector_search(query: str):
-    url = "https://ai-foodhak.com/chromadb_vecstore"
+    # Near-identical questions share one cached result set
+    normalized = normalize_query(query)
+    cache_key = hashlib.sha1(normalized.encode()).hexdigest()
+    return await vector_cache.get(cache_key, lambda: fetch_vector_results(query))
+
+
+# vector search call with an async version
+async def fetch_vector_results(query: str):
+    url = VECTOR_STORE_URL
     headers = {"Content-Type": "application/json"}
     data = {
         "queries": [query],  # Wrap the query string in a list
         "count": 10
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json=data, headers=headers)
+    response = await timed_post("vector_store", url, json=data, headers=headers)
     if response.status_code == 200:
-        return response.json()
+        return loads(response.content)
     else:
         return {}
 
 
-async def generate_response_with_openai_streaming(client, prompt, system, websocket):
+CLAUDE_MODEL = "claude-3-7-sonnet-20250219"
+GROK_MODEL = "grok-3-mini-fast-beta"
+
+
+# Provider streams are normalised into (kind, value) events so one relay can forward any of them:
+#   ("start", message_id)  upstream message id, sent before any text
+#   ("announce", text)     sent to the client as a message_start frame
+#   ("delta", text)        a piece of the answer
+#   ("stop", text)         sent to the client as the message_stop frame
+# Upstream errors propagate to the caller instead of being turned into error frames here.
+RESUME_INSTRUCTION = (
+    "Your previous reply was cut off. Continue it exactly where it stops, without repeating "
+    "any of it and without commenting on the interruption."
+)
+
+
+async def stream_grok_events(client, prompt, system, partial=None):
     """
-    Streams reasoning_content, final content, and token-usage stats over a WebSocket.
+    Streams the final content and token-usage stats of a Grok completion. With `partial`,
+    continues an answer that another stream started.
     """
-    try:
-        message_id = None
-        full_response = ""
-        full_reasoning_response = ""
-        # 1) Prepare the chat messages
-        messages = [
-            {"role": "system", "content": system},
-            {"role": "user", "content": prompt}
+    # 1) Prepare the chat messages
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": prompt}
+    ]
+    if partial:
+        messages += [
+            {"role": "assistant", "content": partial},
+            {"role": "user", "content": RESUME_INSTRUCTION}
         ]
 
-        # 2) Kick off the streaming completion with usage included
-        response = client.chat.completions.create(
-            model="grok-3-mini-fast-beta",
-            reasoning_effort="high",
-            messages=messages,
-            temperature=0.2,
-            stream=True,
-            stream_options={"include_usage": True}
-        )
+    # 2) Kick off the streaming completion with usage included
+    response = await client.chat.completions.create(
+        model=GROK_MODEL,
+        reasoning_effort="high",
+        messages=messages,
+        temperature=0.2,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
 
-        # Flags to emit our headers exactly once
-        printed_reasoning = False
-        printed_content = False
+    # Flags to emit our headers exactly once
+    message_id = None
+    printed_content = False
+
+    # 3) Iterate asynchronously over each chunk; the context manager releases the
+    #    upstream connection even when the consumer stops early
+    async with response:
+        async for chunk in response:
+            if message_id is None and getattr(chunk, "id", None):
+                message_id = chunk.id
+                yield "start", message_id
 
-        # 3) Iterate synchronously over each chunk
-        for chunk in response:
             # 3a) If choices is empty, it’s the final usage-only packet
             if not getattr(chunk, "choices", None):
                 usage = chunk.usage
+                current_span().set(input_tokens=usage.prompt_tokens, output_tokens=usage.completion_tokens)
                 stats = (
                     f"\n\nNumber of completion tokens (input): "
                     f"{usage.completion_tokens}\n"
                     f"Number of reasoning tokens (input): "
                     f"{usage.completion_tokens_details.reasoning_tokens}"
                 )
-                await safe_send_text(websocket, json.dumps({
-                    "type": "message_stop",
-                    "message_id": message_id,
-                    "data": stats
-                }))
-                break
+                yield "stop", stats
+                return
 
             # 3b) Otherwise there’s exactly one choice with a delta
-            choice = chunk.choices[0]
-            delta = choice.delta
-
+            delta = chunk.choices[0].delta
             if getattr(delta, "content", None):
                 if not printed_content:
                     printed_content = True
-                    await safe_send_text(websocket, json.dumps({
-                        "message_id": message_id,
-                        "type": "message_start",
-                        "data": "\nFinal Response:"
-                    }))
-                await safe_send_text(websocket, json.dumps({
-                    "message_id": message_id,
-                    "type": "streaming",
-                    "data": delta.content
-                }))
+                    yield "announce", "\nFinal Response:"
+                yield "delta", delta.content
+
+
+async def stream_claude_events(client, prompt, system_instruction, partial=None):
+    # system_instruction is a list of text blocks carrying cache_control breakpoints
+    messages = [{"role": "user", "content": prompt}]
+    if partial and partial.rstrip():
+        # Prefill the assistant turn so Claude continues the partial answer; the API
+        # rejects a final assistant turn that ends in whitespace
+        messages.append({"role": "assistant", "content": partial.rstrip()})
+    response = await client.beta.prompt_caching.messages.create(
+        system=system_instruction,
+        messages=messages,
+        model=CLAUDE_MODEL,
+        temperature=0,
+        max_tokens=7024,
+        stream=True,
+    )
 
-            if message_id is None:
-                message_id = chunk.id
+    async with response:
+        async for chunk in response:
+            event_type = getattr(chunk, "type", None)
 
-        return full_response
+            if event_type == "message_start":
+                usage = chunk.message.usage
+                logger.info(
+                    f"Claude prompt tokens - input: {usage.input_tokens}, "
+                    f"cache_read: {getattr(usage, 'cache_read_input_tokens', 0) or 0}, "
+                    f"cache_write: {getattr(usage, 'cache_creation_input_tokens', 0) or 0}"
+                )
+                current_span().set(
+                    input_tokens=usage.input_tokens,
+                    cache_read_tokens=getattr(usage, "cache_read_input_tokens", 0) or 0,
+                    cache_write_tokens=getattr(usage, "cache_creation_input_tokens", 0) or 0,
+                )
+                yield "start", chunk.message.id
 
-    except Exception as e:
-        logging.error(f"Error streaming response with OpenAI: {e}")
-        # Send an error frame if the WS is still open
-        try:
-            await safe_send_text(websocket, json.dumps({
-                "type": "error",
-                "data": str(e)
-            }))
-        except:
-            logging.warning("WebSocket closed before error could be sent")
-        return ""
+            elif event_type == "content_block_delta" and hasattr(chunk.delta, 'text'):
+                yield "delta", chunk.delta.text
+
+            elif event_type == "message_delta" and getattr(chunk, "usage", None):
+                current_span().set(output_tokens=chunk.usage.output_tokens)
+
+            elif event_type == "message_stop":
+                yield "stop", "Message stream completed."
+
+
+STREAM_MAX_FAILOVERS = int(os.getenv("STREAM_MAX_FAILOVERS", "1"))
+
+# Cancelled generations (client "stop", a newer message, or a disconnect). Savings are estimated
+# from the average length of answers that ran to completion.
+cancel_stats = {
+    "cancelled": 0, "stop": 0, "new_message": 0, "disconnect": 0,
+    "tokens_streamed": 0, "tokens_saved_estimate": 0,
+}
+completed_response_tokens = deque(maxlen=500)
+
+
+def record_cancellation(partial: str):
+    streamed = estimate_tokens(partial) if partial else 0
+    expected = sum(completed_response_tokens) / len(completed_response_tokens) if completed_response_tokens else 0
+    cancel_stats["tokens_streamed"] += streamed
+    cancel_stats["tokens_saved_estimate"] += max(int(expected) - streamed, 0)
+
+
+class ProviderStreamError(Exception):
+    """An upstream stream failed; `provider` names the provider that failed."""
+
+    def __init__(self, provider, error):
+        super().__init__(str(error))
+        self.provider = provider
+        self.error = error
+
+
+async def relay_events(events, websocket, resume=None):
+    """
+    Forwards provider events to the client as message_start/streaming/message_stop
+    frames and returns the full response text.
+
+    If the stream fails before message_stop and `resume` is given, `await resume(partial, error)`
+    must return a stream that continues the partial answer; it is relayed under the same
+    message_id, so the client only sees the answer carry on.
+    """
+    frames = StreamingFrameBuffer(websocket)
+    full_response = ""
+    failovers = 0
+    try:
+        while True:
+            resumed = failovers > 0
+            trim_leading_space = resumed and full_response[-1:].isspace()
+            try:
+                async for kind, value in events:
+                    if kind == "start":
+                        if frames.message_id is None:
+                            frames.message_id = value
+                    elif kind == "announce":
+                        if resumed:
+                            continue  # the client already has a message_start for this answer
+                        await frames.flush()
+                        await safe_send_text(websocket, frame("message_start", value, frames.message_id))
+                    elif kind == "delta":
+                        if trim_leading_space:
+                            value = value.lstrip()
+                            trim_leading_space = not value
+                            if not value:
+                                continue
+                        full_response += value
+                        if not await frames.add(value):
+                            break
+                    elif kind == "stop":
+                        await frames.flush()
+                        sent_ok = await safe_send_text(websocket, frame("message_stop", value, frames.message_id))
+                        if not sent_ok:
+                            break
+                break
+            except Exception as e:
+                if resume is None or failovers >= STREAM_MAX_FAILOVERS:
+                    raise
+                failovers += 1
+                stream_stats["failovers"] += 1
+                LLM_FALLBACKS.labels(kind="midstream",
+                                     from_provider=getattr(e, "provider", "unknown")).inc()
+                current_span().event("failover", from_provider=getattr(e, "provider", "unknown"),
+                                     partial_chars=len(full_response))
+                logger.warning(f"Stream {frames.message_id} failed after {len(full_response)} chars ({e}), "
+                               f"resuming on another provider")
+                await frames.flush()
+                try:
+                    events = await resume(full_response, e)
+                except Exception:
+                    stream_stats["failovers_failed"] += 1
+                    raise
+    except asyncio.CancelledError:
+        # Cancelling the task unwinds through the provider generators, which closes the
+        # upstream HTTP streams; tell the client where the answer stopped
+        record_cancellation(full_response)
+        if frames.message_id is not None:
+            await frames.flush()
+            await safe_send_text(websocket, frame("message_stop", "cancelled", frames.message_id))
+        raise
+    finally:
+        # A client that went away ends the relay early; close the stream now rather than at GC
+        # so the upstream request (and a hedge loser still being measured) stops with the turn
+        await events.aclose()
+    await frames.flush()
+    completed_response_tokens.append(estimate_tokens(full_response))
+    return full_response
+
+
+# Hedging: if Claude has not produced its first delta within HEDGE_TTFT_MS, start Grok in
+# parallel and stream whichever produces a delta first; the other stream is cancelled.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_TTFT_MS = float(os.getenv("HEDGE_TTFT_MS", "2500"))
+HEDGE_SAMPLE_SIZE = 1000
+# The losing primary is cancelled as soon as the hedge wins. For a sampled fraction of those
+# races (opt-in) it instead keeps running until its first delta, at most HEDGE_MEASURE_TIMEOUT
+# and never beyond the turn, so its real TTFT can be recorded; nothing it produces is used
+HEDGE_MEASURE_SAMPLE_RATE = float(os.getenv("HEDGE_MEASURE_SAMPLE_RATE", "0"))
+HEDGE_MEASURE_TIMEOUT = float(os.getenv("HEDGE_MEASURE_TIMEOUT", "30"))
+
+hedge_stats = {
+    "requests": 0, "hedged": 0, "primary_wins": 0, "hedge_wins": 0,
+    # Rolling TTFT samples (ms) of what the user saw, and of the primary alone, i.e. what the
+    # user would have seen without hedging. The gap between the two is the tail improvement.
+    "served_ttft_ms": deque(maxlen=HEDGE_SAMPLE_SIZE),
+    "primary_ttft_ms": deque(maxlen=HEDGE_SAMPLE_SIZE),
+    # Lost races whose primary was cancelled (or failed) before its first delta. Its TTFT is
+    # censored: only known to exceed the hedge's, so primary_ttft_ms leaves these slowest cases out.
+    "primary_unmeasured": 0,
+}
+
+
+async def _prime_stream(events):
+    """Reads events up to and including the first delta; returns them for replay."""
+    buffered = []
+    async for event in events:
+        buffered.append(event)
+        if event[0] == "delta":
+            break
+    return buffered
+
+
+async def _replay(buffered, events):
+    for event in buffered:
+        yield event
+    async for event in events:
+        yield event
+
+
+async def _discard_stream(task, events):
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    await events.aclose()
 
 
-async def generate_response_with_claude_streaming(client, prompt, system_instruction, websocket):
+async def _measure_primary(task, events, started):
+    """Lets a primary that lost the hedge race reach its first delta, records its TTFT, then closes it."""
+    measured = False
+    try:
+        await asyncio.wait_for(asyncio.shield(task), timeout=HEDGE_MEASURE_TIMEOUT)
+        hedge_stats["primary_ttft_ms"].append((time.perf_counter() - started) * 1000)
+        measured = True
+    except Exception:
+        pass
+    finally:
+        if not measured:
+            hedge_stats["primary_unmeasured"] += 1
+        await _discard_stream(task, events)
+
+
+async def _measured_alongside(stream, measurement):
+    """Relays the winning stream; the loser's measurement ends with it (done, stopped or disconnected)."""
     try:
+        async for event in stream:
+            yield event
+    finally:
+        measurement.cancel()
+        await asyncio.gather(measurement, return_exceptions=True)
+        await stream.aclose()
+
 
-        message_id = None
-        response = client.messages.create(
-            system=system_instruction,
-            messages=[{"role": "user", "content": prompt}],
-            model="claude-3-7-sonnet-20250219",
-            temperature=0,
-            max_tokens=7024,
-            stream=True,
+def _percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 1)
+
+
+def get_hedge_stats():
+    requests = hedge_stats["requests"]
+    return {
+        "enabled": HEDGE_ENABLED,
+        "threshold_ms": HEDGE_TTFT_MS,
+        "requests": requests,
+        "hedged": hedge_stats["hedged"],
+        "hedge_rate": round(hedge_stats["hedged"] / requests, 4) if requests else 0.0,
+        "primary_wins": hedge_stats["primary_wins"],
+        "hedge_wins": hedge_stats["hedge_wins"],
+        "served_ttft_ms": {p: _percentile(hedge_stats["served_ttft_ms"], p) for p in (50, 95, 99)},
+        "primary_ttft_ms": {p: _percentile(hedge_stats["primary_ttft_ms"], p) for p in (50, 95, 99)},
+        "primary_unmeasured": hedge_stats["primary_unmeasured"],
+        "measure_sample_rate": HEDGE_MEASURE_SAMPLE_RATE,
+    }
+
+
+def open_provider_events(name, prompt, system_instruction, partial=None):
+    if name == "claude":
+        return stream_claude_events(claude_client, prompt, system_instruction, partial)
+    return stream_grok_events(get_openai_client(), prompt, system_blocks_to_text(system_instruction), partial)
+
+
+# Circuit breakers: per-provider rolling error/latency windows. Outcomes are also counted in
+# time buckets in Redis so every worker sees the cluster-wide picture, and an open breaker is
+# published as a shared `open_until` timestamp.
+BREAKER_WINDOW_SECONDS = int(os.getenv("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_BUCKET_SECONDS = int(os.getenv("BREAKER_BUCKET_SECONDS", "5"))
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "5"))
+BREAKER_ERROR_THRESHOLD = float(os.getenv("BREAKER_ERROR_THRESHOLD", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_SLOW_TTFT_MS = float(os.getenv("BREAKER_SLOW_TTFT_MS", "8000"))
+BREAKER_SYNC_INTERVAL = float(os.getenv("BREAKER_SYNC_INTERVAL", "2"))
+PROVIDER_ORDER = [p.strip() for p in os.getenv("PROVIDER_ORDER", "claude,grok").split(",") if p.strip()]
+PROVIDER_LABELS = {"claude": "Claude", "grok": "Grok"}
+
+
+def is_provider_failure(error) -> bool:
+    # Our own bad requests should not trip the breaker; throttling, overload and 5xx should
+    status = getattr(error, "status_code", None)
+    return not (status and 400 <= status < 500 and status not in (408, 409, 429))
+
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.samples = deque()  # (timestamp, ok, ttft_ms)
+        self.open_until = 0.0
+        self.reset_at = 0.0
+        self.probe_started = 0.0
+        self.cluster = None  # last aggregate synced from Redis
+        self.stats = {"successes": 0, "failures": 0, "opened": 0, "skipped": 0}
+
+    def _redis_prefix(self) -> str:
+        # The hash tag keeps every key of one provider in a single cluster slot
+        return f"breaker:{{{self.name}}}"
+
+    @property
+    def state(self) -> str:
+        if time.time() < self.open_until:
+            return "open"
+        if self.open_until:
+            return "half_open"
+        return "closed"
+
+    def window(self):
+        """Returns (requests, errors, avg_ttft_ms), preferring the cluster-wide aggregate."""
+        cutoff = max(time.time() - BREAKER_WINDOW_SECONDS, self.reset_at)
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        local = (
+            len(self.samples),
+            sum(1 for _, ok, _ in self.samples if not ok),
+            [ttft for _, ok, ttft in self.samples if ok and ttft is not None],
         )
+        requests, errors, ttfts = local
+        avg_ttft = sum(ttfts) / len(ttfts) if ttfts else None
+        if self.cluster and self.cluster["requests"] >= requests:
+            return self.cluster["requests"], self.cluster["errors"], self.cluster["avg_ttft_ms"] or avg_ttft
+        return requests, errors, avg_ttft
+
+    def probe_available(self) -> bool:
+        # A single probe decides whether to close again; an abandoned probe expires
+        return self.state == "half_open" and time.time() - self.probe_started > BREAKER_OPEN_SECONDS
+
+    def allow(self) -> bool:
+        """Whether the provider may be offered as a candidate; claims nothing."""
+        if self.state == "closed" or self.probe_available():
+            return True
+        self.stats["skipped"] += 1
+        return False
 
-        full_response = ""
-        for chunk in response:
-            if hasattr(chunk, 'type'):
-                # Handle each chunk based on its type
-                event_type = chunk.type
-
-                if event_type == "message_start":
-                    # Extract the message ID
-                    message_id = chunk.message.id
-
-                elif event_type == "content_block_delta" and hasattr(chunk.delta, 'text'):
-                    # Stream each chunk of text with message ID
-                    delta_text = chunk.delta.text
-                    full_response += delta_text
-
-                    sent_ok = await safe_send_text(websocket, json.dumps({
-                        "message_id": message_id,
-                        "type": "streaming",
-                        "data": delta_text
-                    }))
-                    if not sent_ok:
-                        break
-                        # Allow other tasks to run
-                    await asyncio.sleep(0)
-
-                elif event_type == "message_stop":
-                    # Send the final message_stop event
-
-                    sent_ok = await safe_send_text(websocket, json.dumps({
-                        "message_id": message_id,
-                        "type": "message_stop",
-                        "data": "Message stream completed."
-                    }))
-                    if not sent_ok:
-                        break
-        return full_response
+    def begin_attempt(self) -> bool:
+        """Called just before a request is sent: claims the half-open probe, False if it is taken."""
+        if self.state != "half_open":
+            return True
+        if not self.probe_available():
+            return False
+        self.probe_started = time.time()
+        return True
+
+    def record(self, ok: bool, ttft_ms=None):
+        now = time.time()
+        self.samples.append((now, ok, ttft_ms))
+        self.stats["successes" if ok else "failures"] += 1
+        state = self.state
+        if state == "half_open":
+            self.probe_started = 0.0
+            if ok:
+                logger.info(f"Circuit breaker for {self.name} closed after a successful probe")
+                self.open_until = 0.0
+                self.reset_at = now
+                self.cluster = None
+            else:
+                self.trip()
+        elif state == "closed":
+            # Failures of streams already in flight when the breaker opened must not extend it
+            requests, errors, _ = self.window()
+            if not ok and requests >= BREAKER_MIN_REQUESTS and errors / requests >= BREAKER_ERROR_THRESHOLD:
+                self.trip()
+        spawn_background(self._publish_sample(now, ok, ttft_ms))
+
+    def trip(self):
+        self.open_until = time.time() + BREAKER_OPEN_SECONDS
+        self.stats["opened"] += 1
+        logger.warning(f"Circuit breaker for {self.name} opened for {BREAKER_OPEN_SECONDS:.0f}s")
+        spawn_background(self._publish_open())
+
+    async def _publish_sample(self, now, ok, ttft_ms):
+        bucket_key = f"{self._redis_prefix()}:{int(now // BREAKER_BUCKET_SECONDS)}"
+        try:
+            async with redis_client.pipeline() as pipe:
+                pipe.hincrby(bucket_key, "requests", 1)
+                if not ok:
+                    pipe.hincrby(bucket_key, "errors", 1)
+                if ok and ttft_ms is not None:
+                    pipe.hincrby(bucket_key, "ttft_count", 1)
+                    pipe.hincrbyfloat(bucket_key, "ttft_sum", ttft_ms)
+                pipe.expire(bucket_key, BREAKER_WINDOW_SECONDS + BREAKER_BUCKET_SECONDS)
+                await pipe.execute()
+        except Exception as e:
+            logger.debug(f"Circuit breaker sample for {self.name} not published: {e}")
+
+    async def _publish_open(self):
+        try:
+            await redis_client.set(f"{self._redis_prefix()}:open_until", self.open_until,
+                                   ex=max(1, int(BREAKER_OPEN_SECONDS)))
+        except Exception as e:
+            logger.debug(f"Circuit breaker state for {self.name} not published: {e}")
+
+    async def sync(self):
+        """Pulls the cluster-wide window and shared open state from Redis."""
+        now = time.time()
+        first_bucket = int(max(now - BREAKER_WINDOW_SECONDS, self.reset_at) // BREAKER_BUCKET_SECONDS)
+        buckets = range(first_bucket, int(now // BREAKER_BUCKET_SECONDS) + 1)
+        async with redis_client.pipeline() as pipe:
+            pipe.get(f"{self._redis_prefix()}:open_until")
+            for bucket in buckets:
+                pipe.hgetall(f"{self._redis_prefix()}:{bucket}")
+            shared_open_until, *counts = await pipe.execute()
+        if shared_open_until and float(shared_open_until) > self.open_until:
+            self.open_until = float(shared_open_until)
+        ttft_count = sum(int(c.get("ttft_count", 0)) for c in counts)
+        self.cluster = {
+            "requests": sum(int(c.get("requests", 0)) for c in counts),
+            "errors": sum(int(c.get("errors", 0)) for c in counts),
+            "avg_ttft_ms": sum(float(c.get("ttft_sum", 0)) for c in counts) / ttft_count if ttft_count else None,
+        }
+
+    def snapshot(self):
+        requests, errors, avg_ttft = self.window()
+        return {
+            "state": self.state,
+            "requests": requests,
+            "error_rate": round(errors / requests, 4) if requests else 0.0,
+            "avg_ttft_ms": round(avg_ttft, 1) if avg_ttft is not None else None,
+            **self.stats,
+        }
+
+
+class ProviderRouter:
+    """Orders providers by preference, demoting slow ones; providers with an open breaker are skipped."""
+
+    def __init__(self, names):
+        self.names = names
+        self.breakers = {name: CircuitBreaker(name) for name in names}
+        self.stats = {"fallbacks": 0, "all_unavailable": 0}
+
+    def candidates(self):
+        """Returns (providers to try in order, providers skipped because their breaker is open)."""
+        ready, degraded, skipped = [], [], []
+        for name in self.names:
+            breaker = self.breakers[name]
+            if breaker.state == "closed":
+                _, _, avg_ttft = breaker.window()
+                (degraded if avg_ttft is not None and avg_ttft > BREAKER_SLOW_TTFT_MS else ready).append(name)
+            elif breaker.allow():
+                # Half-open probes keep their preference slot, otherwise a recovered provider never gets traffic
+                ready.append(name)
+            else:
+                skipped.append(name)
+        ordered = ready + degraded
+        if not ordered:
+            # Everything is open: still try the preferred provider rather than refusing outright
+            self.stats["all_unavailable"] += 1
+            ordered = self.names[:1]
+        return ordered, [name for name in skipped if name not in ordered]
+
+    def begin_attempt(self, name) -> bool:
+        return self.breakers[name].begin_attempt()
+
+    def release_probe(self, name):
+        # The probe ended without an outcome (bad request, or its stream was discarded)
+        if self.breakers[name].state == "half_open":
+            self.breakers[name].probe_started = 0.0
+
+    def record_skipped(self, skipped, used):
+        # An open breaker only caused a fallback if its provider is preferred over the one used
+        for name in skipped:
+            if self.names.index(name) < self.names.index(used):
+                LLM_FALLBACKS.labels(kind="breaker_open", from_provider=name).inc()
+
+    def record(self, name, ok, ttft_ms=None):
+        self.breakers[name].record(ok, ttft_ms)
+
+    def record_error(self, name, error):
+        if is_provider_failure(error):
+            self.record(name, False)
+        else:
+            self.release_probe(name)
+
+    async def sync_loop(self):
+        while True:
+            await asyncio.sleep(BREAKER_SYNC_INTERVAL)
+            for breaker in self.breakers.values():
+                try:
+                    await breaker.sync()
+                except Exception as e:
+                    logger.debug(f"Circuit breaker sync for {breaker.name} failed: {e}")
 
+    def snapshot(self):
+        return {
+            "order": self.candidates_preview(),
+            "providers": {name: breaker.snapshot() for name, breaker in self.breakers.items()},
+            **self.stats,
+        }
+
+    def candidates_preview(self):
+        return [name for name in self.names if self.breakers[name].state != "open"]
+
+
+provider_router = ProviderRouter(PROVIDER_ORDER)
+_background_tasks = set()
+
+
+def spawn_background(coro):
+    # Keeps a reference so fire-and-forget tasks are not garbage collected mid-flight
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _observe(name, started, events, buffered):
+    """
+    Replays the primed events, then streams the rest, recording the outcome on the breaker
+    and the provider's TTFT and streaming rate in the metrics. A stream that ends without
+    its stop event (a dropped connection the SDK reports as a normal end) is a failure.
+    """
+    first_token_at = time.perf_counter()
+    ttft_ms = (first_token_at - started) * 1000
+    LLM_TIME_TO_FIRST_TOKEN.labels(provider=name).observe(ttft_ms / 1000)
+    current_span().event("first_token", provider=name, ttft_ms=round(ttft_ms, 1))
+    streamed_chars = 0
+    stopped = False
+    try:
+        for event in buffered:
+            stopped = stopped or event[0] == "stop"
+            yield event
+        async for event in events:
+            if event[0] == "delta":
+                streamed_chars += len(event[1])
+            elif event[0] == "stop":
+                stopped = True
+            yield event
+        if not stopped:
+            raise RuntimeError(f"{PROVIDER_LABELS.get(name, name)} stream ended before its stop event")
     except Exception as e:
-        logging.error(f"Error streaming response with Claude: {e}")
+        LLM_STREAMS.labels(provider=name, outcome="error").inc()
+        provider_router.record_error(name, e)
+        raise ProviderStreamError(name, e) from e
+    else:
+        LLM_STREAMS.labels(provider=name, outcome="ok").inc()
+        elapsed = time.perf_counter() - first_token_at
+        if streamed_chars and elapsed > 0:
+            # ~4 characters per token, the same estimate as estimate_tokens
+            LLM_TOKENS_PER_SECOND.labels(provider=name).observe(streamed_chars / 4 / elapsed)
+        current_span().set(provider=name)
+        provider_router.record(name, True, ttft_ms)
 
-        sent_ok = await safe_send_text(websocket, json.dumps({
-            "type": "error",
-            "data": str(e)
-        }))
-        if not sent_ok:
-            logger.warning("Attempted to send on a closed WebSocket")
-        return ""
+
+async def open_routed_stream(prompt, system_instruction, partial=None, exclude=()):
+    """
+    Opens a stream on the healthiest provider, failing over to the next candidate when a
+    provider errors before its first delta. Returns the event stream.
+
+    `partial` continues an answer another provider started; `exclude` skips the providers
+    that already failed it.
+    """
+    candidates, skipped = provider_router.candidates()
+    candidates = [name for name in candidates if name not in exclude]
+    if not candidates:
+        raise RuntimeError("No other LLM provider is available")
+    if HEDGE_ENABLED and not partial and len(candidates) > 1 and provider_router.begin_attempt(candidates[0]):
+        return await open_hedged_stream(candidates[0], candidates[1], prompt, system_instruction, skipped)
+    last_error = None
+    previous = None
+    for name in candidates:
+        if not provider_router.begin_attempt(name):
+            continue  # Another request is probing this half-open provider
+        if previous:
+            provider_router.stats["fallbacks"] += 1
+            LLM_FALLBACKS.labels(kind="before_first_token", from_provider=previous).inc()
+            logger.warning(f"Falling back to {PROVIDER_LABELS.get(name, name)}...")
+        previous = name
+        logging.info(f"Attempting response generation with {PROVIDER_LABELS.get(name, name)}...")
+        started = time.perf_counter()
+        try:
+            events = open_provider_events(name, prompt, system_instruction, partial)
+            buffered = await _prime_stream(events)
+        except Exception as e:
+            logger.error(f"{PROVIDER_LABELS.get(name, name)} failed before streaming: {e}")
+            current_span().event("provider_failed", provider=name, error=str(e))
+            provider_router.record_error(name, e)
+            last_error = e
+            continue
+        provider_router.record_skipped(skipped, name)
+        return _observe(name, started, events, buffered)
+    raise last_error or RuntimeError("No LLM provider is available")
+
+
+async def open_hedged_stream(primary_name, hedge_name, prompt, system_instruction, skipped=()):
+    """
+    Returns an event stream positioned after the first delta of whichever provider answered
+    first. Raises the primary's error if both providers fail before producing a delta.
+    The caller has already claimed the primary's attempt (begin_attempt).
+    """
+    hedge_stats["requests"] += 1
+    started = time.perf_counter()
+    primary = open_provider_events(primary_name, prompt, system_instruction)
+    primary_task = asyncio.create_task(_prime_stream(primary))
+    hedge = hedge_task = None
+    try:
+        done, _ = await asyncio.wait({primary_task}, timeout=HEDGE_TTFT_MS / 1000)
+        if done and primary_task.exception() is None:
+            ttft = (time.perf_counter() - started) * 1000
+            hedge_stats["primary_wins"] += 1
+            hedge_stats["served_ttft_ms"].append(ttft)
+            hedge_stats["primary_ttft_ms"].append(ttft)
+            provider_router.record_skipped(skipped, primary_name)
+            return _observe(primary_name, started, primary, primary_task.result())
+
+        if not provider_router.begin_attempt(hedge_name):
+            # Another request is probing the hedge provider: wait for the primary alone
+            await asyncio.wait({primary_task})
+            if primary_task.exception() is not None:
+                provider_router.record_error(primary_name, primary_task.exception())
+                raise primary_task.exception()
+            ttft = (time.perf_counter() - started) * 1000
+            hedge_stats["primary_wins"] += 1
+            hedge_stats["served_ttft_ms"].append(ttft)
+            hedge_stats["primary_ttft_ms"].append(ttft)
+            provider_router.record_skipped(skipped, primary_name)
+            return _observe(primary_name, started, primary, primary_task.result())
+
+        # The primary is slow (or already failed): race the hedge provider against it
+        hedge_stats["hedged"] += 1
+        logger.info(f"Hedging: no {primary_name} delta after {(time.perf_counter() - started) * 1000:.0f} ms, "
+                    f"starting {hedge_name}")
+        hedge = open_provider_events(hedge_name, prompt, system_instruction)
+        hedge_task = asyncio.create_task(_prime_stream(hedge))
+        pending = {primary_task, hedge_task}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = primary_name if task is primary_task else hedge_name
+                if task.exception() is not None:
+                    logger.warning(f"Hedging: {name} failed: {task.exception()}")
+                    provider_router.record_error(name, task.exception())
+                    continue
+                ttft = (time.perf_counter() - started) * 1000
+                hedge_stats["served_ttft_ms"].append(ttft)
+                if task is primary_task:
+                    hedge_stats["primary_wins"] += 1
+                    hedge_stats["primary_ttft_ms"].append(ttft)
+                    await _discard_stream(hedge_task, hedge)
+                    provider_router.release_probe(hedge_name)
+                    provider_router.record_skipped(skipped, primary_name)
+                    return _observe(primary_name, started, primary, task.result())
+                hedge_stats["hedge_wins"] += 1
+                LLM_FALLBACKS.labels(kind="hedge", from_provider=primary_name).inc()
+                logger.info(f"Hedging: {hedge_name} won with TTFT {ttft:.0f} ms (threshold {HEDGE_TTFT_MS:.0f} ms)")
+                provider_router.release_probe(primary_name)
+                provider_router.record_skipped(skipped, hedge_name)
+                stream = _observe(hedge_name, started, hedge, task.result())
+                if not primary_task.done() and random.random() < HEDGE_MEASURE_SAMPLE_RATE:
+                    measurement = asyncio.create_task(_measure_primary(primary_task, primary, started))
+                    return _measured_alongside(stream, measurement)
+                # The primary already failed, or is cancelled now; its TTFT stays censored
+                hedge_stats["primary_unmeasured"] += 1
+                await _discard_stream(primary_task, primary)
+                return stream
+    except asyncio.CancelledError:
+        # The client went away or asked to stop: abort both upstream requests
+        await _discard_stream(primary_task, primary)
+        provider_router.release_probe(primary_name)
+        if hedge_task is not None:
+            await _discard_stream(hedge_task, hedge)
+            provider_router.release_probe(hedge_name)
+        raise
+    raise primary_task.exception()
 
 
 async def get_user_profile(foodhak_user_id):
+    # Profiles rarely change within a session, so serve the processed profile from the cache
+    return await profile_cache.get(str(foodhak_user_id), lambda: fetch_user_profile(foodhak_user_id))
+
+
+async def fetch_user_profile(foodhak_user_id):
     url = os.getenv('STAGING_OPENSEARCH_HOST')
 
     query = {
@@ -276,95 +1342,12 @@ async def get_user_profile(foodhak_user_id):
     user = os.getenv('STAGING_OPENSEARCH_USER')
     password = os.getenv('STAGING_OPENSEARCH_PWD')
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json=query, auth=(user, password))
+    response = await timed_post("opensearch", url, json=query, auth=(user, password))
 
     if response.status_code == 200:
-        results = response.json()
+        results = loads(response.content)
         if results['hits']['total']['value'] > 0:
-            result = results['hits']['hits'][0]['_source']
-
-            user_health_goals = result.get("user_health_goals", [])
-            primary_goal = next((goal for goal in user_health_goals if goal.get("user_goal", {}).get("is_primary")),
-                                None)
-            primary_goal_title = primary_goal["user_goal"].get("title") if primary_goal else (
-                user_health_goals[0]["user_goal"].get("title") if user_health_goals else None
-            )
-
-            # Define nutrient formatting rules
-            nutrient_mapping = {
-                "energy": "Energy (KCAL)",
-                "protein": "Protein (G)",
-                "fats": "Total Fat (G)",
-                "saturated fat": "Saturated Fat (G)",
-                "cholesterol": "Cholesterol (MG)",
-                "sodium": "Sodium Na (MG)",
-                "carbohydrates": "Total Carbohydrate (G)",
-                "dietary fibre": "Dietary Fiber (G)",
-                "vitamin c": "Vitamin C (MG)",
-                "calcium": "Calcium (MG)",
-                "iron": "Iron (MG)",
-                "potassium": "Potassium K (MG)",
-                "hydration": "Hydration (ML)"
-            }
-
-            # Extract nutrients with proper formatting
-            nutrients_data = result.get("nutrients", {}).get("results", {})
-            formatted_nutrients = {}
-
-            for nutrient_type_list in nutrients_data.values():
-                for nutrient_type in nutrient_type_list:
-                    item_name = nutrient_type.get("nutrition_guideline", {}).get("item", "").strip()
-                    item_name_lower = item_name.lower()
-
-                    # Check if the nutrient name is in the mapping
-                    if item_name_lower in nutrient_mapping:
-                        formatted_name = nutrient_mapping[item_name_lower]
-                        formatted_nutrients[formatted_name] = str(nutrient_type.get("target_value"))
-
-            profile_info = {
-                "User Name": result.get("name"),
-                "User Age": result.get("age"),
-                "User Sex": result.get("sex"),
-                "User Height": result.get("height"),
-                "User Weight": result.get("weight"),
-                "User Ethnicity": result.get("ethnicity", {}).get("title"),
-                "Primary Goal Title": primary_goal_title,
-                "Goal Titles": [
-                    goal_sub["title"] for goal in result.get("user_health_goals", [])
-                    for key in ["user_goal", "user_goals"] if key in goal
-                    for goal_sub in (goal[key] if isinstance(goal[key], list) else [goal[key]])
-                ],
-                "Ingredients to Recommend": [
-                    {
-                        "common_name": ingredient.get("common_name"),
-                        "first_relationship_extract": ingredient["relationships"][0]["extracts"] if ingredient[
-                            "relationships"] else None,
-                        "first_relationship_url": ingredient["relationships"][0]["url"] if ingredient[
-                            "relationships"] else None
-                    }
-                    for goal in result.get("user_health_goals", [])
-                    for ingredient in goal.get("ingredients_to_recommend", [])
-                ],
-                "Ingredients to Avoid": [
-                    {
-                        "common_name": ingredient.get("common_name"),
-                        "first_relationship_extract": ingredient["relationships"][0]["extracts"] if ingredient[
-                            "relationships"] else None,
-                        "first_relationship_url": ingredient["relationships"][0]["url"] if ingredient[
-                            "relationships"] else None
-                    }
-                    for goal in result.get("user_health_goals", [])
-                    for ingredient in goal.get("ingredients_to_avoid", [])
-                ],
-                "Dietary Restriction Name": result.get("dietary_restrictions", {}).get("name"),
-                "Allergens Types": [
-                    allergen.get("type")
-                    for allergen in result.get("allergens", [])
-                ],
-                "Daily Nutritional Requirement": formatted_nutrients
-            }
-            return profile_info
+            return transform_user_profile(results['hits']['hits'][0]['_source'])
         else:
             logger.error("No matching user profile found.")
             return None
@@ -373,53 +1356,117 @@ async def get_user_profile(foodhak_user_id):
         return None
 
 
-def build_prompt(query, vec_results, conversation_history, users_name, users_age, users_sex, users_height, users_weight, users_ethnicity, goal_title,
-                 ingredient_recommend, ingredient_avoid, dietary_restriction, allergens_type, primary_goal_title,
-                 daily_nutritional_requirement):
-    # print("Ingredient Recommended:", ingredient_recommend)
+def transform_user_profile(result):
+    """Builds the profile_info dict used by build_prompt from an OpenSearch `_source` document."""
+    user_health_goals = result.get("user_health_goals", [])
+    primary_goal = next((goal for goal in user_health_goals if goal.get("user_goal", {}).get("is_primary")),
+                        None)
+    primary_goal_title = primary_goal["user_goal"].get("title") if primary_goal else (
+        user_health_goals[0]["user_goal"].get("title") if user_health_goals else None
+    )
+
+    # Define nutrient formatting rules
+    nutrient_mapping = {
+        "energy": "Energy (KCAL)",
+        "protein": "Protein (G)",
+        "fats": "Total Fat (G)",
+        "saturated fat": "Saturated Fat (G)",
+        "cholesterol": "Cholesterol (MG)",
+        "sodium": "Sodium Na (MG)",
+        "carbohydrates": "Total Carbohydrate (G)",
+        "dietary fibre": "Dietary Fiber (G)",
+        "vitamin c": "Vitamin C (MG)",
+        "calcium": "Calcium (MG)",
+        "iron": "Iron (MG)",
+        "potassium": "Potassium K (MG)",
+        "hydration": "Hydration (ML)"
+    }
 
-    system_instruction = f"""
-You are **Faye**, Foodhak's authoritative yet approachable nutrition side-kick.  
+    # Extract nutrients with proper formatting
+    nutrients_data = result.get("nutrients", {}).get("results", {})
+    formatted_nutrients = {}
+
+    for nutrient_type_list in nutrients_data.values():
+        for nutrient_type in nutrient_type_list:
+            item_name = nutrient_type.get("nutrition_guideline", {}).get("item", "").strip()
+            item_name_lower = item_name.lower()
+
+            # Check if the nutrient name is in the mapping
+            if item_name_lower in nutrient_mapping:
+                formatted_name = nutrient_mapping[item_name_lower]
+                formatted_nutrients[formatted_name] = str(nutrient_type.get("target_value"))
+
+    profile_info = {
+        "User Name": result.get("name"),
+        "User Age": result.get("age"),
+        "User Sex": result.get("sex"),
+        "User Height": result.get("height"),
+        "User Weight": result.get("weight"),
+        "User Ethnicity": result.get("ethnicity", {}).get("title"),
+        "Primary Goal Title": primary_goal_title,
+        "Goal Titles": [
+            goal_sub["title"] for goal in result.get("user_health_goals", [])
+            for key in ["user_goal", "user_goals"] if key in goal
+            for goal_sub in (goal[key] if isinstance(goal[key], list) else [goal[key]])
+        ],
+        "Ingredients to Recommend": [
+            {
+                "common_name": ingredient.get("common_name"),
+                "first_relationship_extract": ingredient["relationships"][0]["extracts"] if ingredient[
+                    "relationships"] else None,
+                "first_relationship_url": ingredient["relationships"][0]["url"] if ingredient[
+                    "relationships"] else None
+            }
+            for goal in result.get("user_health_goals", [])
+            for ingredient in goal.get("ingredients_to_recommend", [])
+        ],
+        "Ingredients to Avoid": [
+            {
+                "common_name": ingredient.get("common_name"),
+                "first_relationship_extract": ingredient["relationships"][0]["extracts"] if ingredient[
+                    "relationships"] else None,
+                "first_relationship_url": ingredient["relationships"][0]["url"] if ingredient[
+                    "relationships"] else None
+            }
+            for goal in result.get("user_health_goals", [])
+            for ingredient in goal.get("ingredients_to_avoid", [])
+        ],
+        "Dietary Restriction Name": result.get("dietary_restrictions", {}).get("name"),
+        "Allergens Types": [
+            allergen.get("type")
+            for allergen in result.get("allergens", [])
+        ],
+        "Daily Nutritional Requirement": formatted_nutrients
+    }
+    return profile_info
+
+
+# Persona and rules shared by every user. Sent as its own system block so the
+# provider-side prompt cache can reuse it across users and turns.
+SYSTEM_INSTRUCTION_STATIC = """You are **Faye**, Foodhak's authoritative yet approachable nutrition side-kick.  
 Your mission is to deliver precise, evidence-based food and health guidance, personalised to each user's needs, in a calm, concise, and genuinely helpful tone.
 
 ────────────────────────────────────────────
 1. Conversational Style
 ────────────────────────────────────────────
-• Warm-but-measured greeting – greet the user **once per session** (e.g. "Hi {users_name}—") and never repeat it.  
+• Warm-but-measured greeting – greet the user **once per session** (e.g. "Hi <Name>—", using the Name from Personalisation Inputs) and never repeat it.  
 • Tone – friendly, supportive, professional; no excess exclamation marks or slang.  
 • Brevity – for simple queries, reply in one short paragraph unless more detail is clearly useful.  
 • Emojis – maximum **one** per answer, only if it adds warmth or clarity.
 
 ────────────────────────────────────────────
-2. Personalisation Inputs
-────────────────────────────────────────────
-Name: {users_name} Age: {users_age} Sex: {users_sex}  
-Height: {users_height} Weight: {users_weight} Ethnicity: {users_ethnicity}
-
-Primary Goal: {primary_goal_title}  
-Other Goals:  {goal_title}
-
-Dietary Preferences/Restrictions: {dietary_restriction}  
-Allergies: {allergens_type}
-
-Recommended Ingredients: {ingredient_recommend}  
-Ingredients to Avoid:   {ingredient_avoid}
-
-Daily Nutrient Targets: {daily_nutritional_requirement}
-
-────────────────────────────────────────────
-3. Content Rules
+2. Content Rules
 ────────────────────────────────────────────
 1. Evidence focus – combine broad nutrition knowledge with latest science.  
 2. **No unsolicited alternatives** – suggest substitutes only on request **or** if a chosen food conflicts with allergies/goals.  
 3. Immediate fulfilment – if the user accepts an offer (e.g. wants a recipe), provide it at once; avoid "fetching" language.  
 4. Ask follow-up questions only when essential.  
 5. Internal query classification (`general` vs `Foodhak-db`, never reveal).  
-   • If `Foodhak-db`, integrate {vec_results} (excluding recipes) and append:  
+   • If `Foodhak-db`, integrate the **Vector Results** from the user message (excluding recipes) and append:  
      `<br/>This answer is verified by Foodhak.`
 
 ────────────────────────────────────────────
-4. HTML Formatting Guide
+3. HTML Formatting Guide
 ────────────────────────────────────────────
 Wrap every answer in minimal, valid HTML:
 
@@ -435,226 +1482,1024 @@ Wrap every answer in minimal, valid HTML:
 Use `<strong>` or `<em>` sparingly; use `<h2>` for clear section headings; close all tags.
 
 ────────────────────────────────────────────
-5. Conversation-Flow Logic (internal)
+4. Conversation-Flow Logic (internal)
 ────────────────────────────────────────────
-IF first message in thread AND greeting not yet used → greet {users_name} once  
+IF first message in thread AND greeting not yet used → greet the user by Name once  
 ELSE → continue without any additional greeting
 
 ────────────────────────────────────────────
-6. Response Checklist (internal, silent)
+5. Response Checklist (internal, silent)
 ────────────────────────────────────────────
 □ Personal data applied where relevant  
 □ Scientific accuracy checked  
 □ No repeat greeting / no excess enthusiasm  
 □ No unsolicited alternatives  
 □ HTML valid & tidy  
-□ Added Foodhak verification line if {vec_results} used  
+□ Added Foodhak verification line if Vector Results used  
 
 Be the most trusted nutrition ally—succinct, evidence-driven, and always user-centric.
 """
 
+PROMPT_PREFIX_CACHE_SIZE = int(os.getenv("PROMPT_PREFIX_CACHE_SIZE", "5000"))
+_profile_instruction_cache = OrderedDict()
+
+
+def render_profile_instruction(user_profile):
+    return f"""
+────────────────────────────────────────────
+6. Personalisation Inputs
+────────────────────────────────────────────
+Name: {user_profile.get("User Name")} Age: {user_profile.get("User Age")} Sex: {user_profile.get("User Sex")}  
+Height: {user_profile.get("User Height")} Weight: {user_profile.get("User Weight")} Ethnicity: {user_profile.get("User Ethnicity")}
+
+Primary Goal: {user_profile.get("Primary Goal Title")}  
+Other Goals:  {user_profile.get("Goal Titles")}
+
+Dietary Preferences/Restrictions: {user_profile.get("Dietary Restriction Name")}  
+Allergies: {user_profile.get("Allergens Types")}
+
+Recommended Ingredients: {user_profile.get("Ingredients to Recommend")}  
+Ingredients to Avoid:   {user_profile.get("Ingredients to Avoid")}
+
+Daily Nutrient Targets: {user_profile.get("Daily Nutritional Requirement")}
+"""
+
+
+def get_system_blocks(user_profile):
+    """
+    Returns the system prompt as Anthropic text blocks: the static rules followed by the
+    user's profile, each ending in a cache breakpoint. The rendered profile block is
+    memoized so every turn of a session sends a byte-identical, cacheable prefix.
+    """
+    fingerprint = hashlib.sha1(dumps(user_profile, sort_keys=True, lenient=True).encode()).hexdigest()
+    profile_text = _profile_instruction_cache.get(fingerprint)
+    if profile_text is None:
+        profile_text = render_profile_instruction(user_profile)
+        _profile_instruction_cache[fingerprint] = profile_text
+        while len(_profile_instruction_cache) > PROMPT_PREFIX_CACHE_SIZE:
+            _profile_instruction_cache.popitem(last=False)
+    else:
+        _profile_instruction_cache.move_to_end(fingerprint)
+    return [
+        {"type": "text", "text": SYSTEM_INSTRUCTION_STATIC, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": profile_text, "cache_control": {"type": "ephemeral"}},
+    ]
+
+
+def system_blocks_to_text(system_blocks):
+    # Providers without block-level prompt caching (Grok) take the system prompt as one string
+    return "".join(block["text"] for block in system_blocks)
+
+
+def build_prompt(query, vec_results, conversation_history, user_profile, conversation_summary=None):
+    # Only the per-turn suffix (query, history, vector results) is rendered on every call
+    system_blocks = get_system_blocks(user_profile)
+    summary_section = f"**Earlier Conversation Summary:** {conversation_summary}\n\n" if conversation_summary else ""
+
     prompt = f"""
 **Current Query:** "{query}"
 
-**Conversation History:** {conversation_history}
+{summary_section}**Conversation History:** {conversation_history}
 
 **Vector Results:** {vec_results}
 
 <<Generate final HTML-formatted reply here, following the System Prompt rules>>
 """
-    return prompt, system_instruction
+    return prompt, system_blocks
+
+# Per-stage deadlines (seconds) for the context fan-out in generate_response
+STAGE_TIMEOUT_HISTORY = float(os.getenv("STAGE_TIMEOUT_HISTORY", "2"))
+STAGE_TIMEOUT_PROFILE = float(os.getenv("STAGE_TIMEOUT_PROFILE", "5"))
+STAGE_TIMEOUT_VECTOR = float(os.getenv("STAGE_TIMEOUT_VECTOR", "3"))
+
+
+async def run_stage(name, coro, timeout, fallback, timings):
+    """
+    Awaits one context stage under its own deadline. On timeout or error the stage
+    degrades to `fallback` instead of failing the whole turn. Elapsed ms go into `timings`.
+    """
+    start = time.perf_counter()
+    with tracer.span(f"context.{name}") as span:
+        try:
+            return await asyncio.wait_for(coro, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stage '{name}' exceeded its {timeout}s deadline; continuing with fallback.")
+            span.set(degraded="timeout")
+            return fallback
+        except Exception as e:
+            logger.error(f"Stage '{name}' failed: {e}; continuing with fallback.")
+            span.set(degraded="error", error=str(e))
+            return fallback
+        finally:
+            timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
 
 async def generate_response(query, session_key, foodhak_user_id, websocket=None):
-    # Retrieve conversation history from Redis (synchronously)
-    conversation_history = await async_get_conversation_history(session_key)
-    user_profile = await get_user_profile(foodhak_user_id)
-    if not user_profile:
-        return "Error: User profile not found."
-
-    # Extract user details from the profile
-    users_name = user_profile.get("User Name")
-    users_age = user_profile.get("User Age")
-    users_sex = user_profile.get("User Sex")
-    users_height = user_profile.get("User Height")
-    users_weight = user_profile.get("User Weight")
-    users_ethnicity = user_profile.get("User Ethnicity")
-    primary_goal_title = user_profile.get("Primary Goal Title")
-    goal_title = user_profile.get("Goal Titles")
-    ingredient_recommend = user_profile.get("Ingredients to Recommend")
-    ingredient_avoid = user_profile.get("Ingredients to Avoid")
-    dietary_restriction = user_profile.get("Dietary Restriction Name")
-    allergens_type = user_profile.get("Allergens Types")
-
-    # Perform vector search and join the results
-    vec_results = await perform_vector_search(query)
-
-    # Include additional nutritional information
-    daily_nutritional_requirement = user_profile.get("Daily Nutritional Requirement")
-
-    # Build prompt and system instruction using your helper
-    prompt, system_instruction = build_prompt(
-        query, vec_results, conversation_history,
-        users_name, users_age, users_sex, users_height, users_weight, users_ethnicity,
-        goal_title, ingredient_recommend, ingredient_avoid,
-        dietary_restriction, allergens_type,
-        primary_goal_title, daily_nutritional_requirement
+    """
+    Streams the answer to `websocket` and returns its text. Returns "" when the turn failed;
+    the client has been sent an error frame by then and nothing should be saved to history.
+    """
+    # History, profile and vector search are independent, so fetch them concurrently
+    timings = {}
+    (conversation_history, conversation_summary), user_profile, vec_results = await asyncio.gather(
+        run_stage("history", async_get_history_window(session_key), STAGE_TIMEOUT_HISTORY, ([], None), timings),
+        run_stage("profile", get_user_profile(foodhak_user_id), STAGE_TIMEOUT_PROFILE, None, timings),
+        run_stage("vector_search", perform_vector_search(query), STAGE_TIMEOUT_VECTOR, {}, timings),
     )
+    logger.info(f"Context fan-out for {session_key} (ms): {timings}")
+    if not user_profile:
+        # The answer depends on the profile, so this stage has no useful fallback
+        if websocket and not await safe_send_text(websocket, dumps({"type": "error",
+                                                                    "data": "User profile not found."})):
+            logger.warning("Attempted to send on a closed WebSocket")
+        return ""
 
-    try:
-        if websocket:
-            logging.info("Attempting response generation with Claude-Sonnet-3.7...")
-            # Directly await the streaming response from Anthropic Claude
-            return await generate_response_with_claude_streaming(
-                        claude_client,
-                        prompt,
-                        system_instruction,
-                        websocket
-                    )
-        else:
-            # If no websocket is provided, you can implement a non-streaming fallback
-            return "Non-websocket response generation not implemented."
-    except Exception as anthropic_error:
-        # Log the error to see what args look like
-        logging.error(f"Anthropic error args: {anthropic_error.args}")
-        error_data = anthropic_error.args[0] if anthropic_error.args else {}
-
-        # If error_data is not a dict, try to parse it as JSON
-        if not isinstance(error_data, dict):
-            try:
-                error_data = json.loads(error_data)
-            except Exception:
-                error_data = {}
+    # Build the per-turn prompt and the cacheable system blocks
+    with tracer.span("prompt.build") as span:
+        prompt, system_instruction = build_prompt(query, vec_results, conversation_history, user_profile,
+                                                  conversation_summary)
+        span.set(prompt_tokens_estimate=estimate_tokens(prompt + system_blocks_to_text(system_instruction)))
 
-        # Also check the error message string as a fallback
-        error_str = str(anthropic_error)
+    if not websocket:
+        # If no websocket is provided, you can implement a non-streaming fallback
+        return "Non-websocket response generation not implemented."
+    with tracer.span("llm.stream") as span:
+        response = await stream_response(prompt, system_instruction, websocket)
+        span.set(response_chars=len(response))
+        return response
 
-        if error_data.get("error", {}).get("type") == "overloaded_error" or "overloaded_error" in error_str:
-            logging.warning("Claude-sonnet-3.7 is overloaded. Falling back to Grok...")
-            try:
-                openai_client = get_openai_client()
-                if websocket:
-                    logging.info("Using Grok-3 streaming response generation...")
-                    return await generate_response_with_openai_streaming(
-                openai_client,
-                prompt,
-                system_instruction,
-                websocket
-            )
-                else:
-                    return "Non-websocket fallback response not implemented."
-            except Exception as e:
-                logging.error("OpenAI is also overloaded.")
-                error_message = "Both services are currently experiencing high demand. Please try again in a few minutes."
-                if websocket:
-                    logging.info("Sending error through websocket.")
-                    await safe_send_text(websocket, json.dumps({
-                        "type": "error",
-                        "data": str(e)
-                    }))
-                    return error_message
-                else:
-                    logging.error(f"Unexpected error : {e}")
-                    return "Unexpected error during response generation."
-        else:
-            logging.error(f"Anthropic API error: {anthropic_error}")
-            return "Error generating response from Anthropic API."
+
+async def stream_response(prompt, system_instruction, websocket):
+    """Streams the answer to the client through the provider router; returns the text, or "" on failure."""
+    try:
+        # The router skips providers whose circuit breaker is open and fails over before the first token
+        events = await open_routed_stream(prompt, system_instruction)
     except Exception as e:
-        logging.error(f"Unexpected error during response generation: {e}")
-        return "Unexpected error during response generation."
+        logging.error(f"Response generation failed on every provider: {e}")
+        error_message = "Both services are currently experiencing high demand. Please try again in a few minutes."
+    else:
+        async def resume(partial, error):
+            # Continue on a provider other than the one whose stream just died
+            failed = {error.provider} if isinstance(error, ProviderStreamError) else set()
+            return await open_routed_stream(prompt, system_instruction, partial=partial, exclude=failed)
 
+        try:
+            return await relay_events(events, websocket, resume=resume)
+        except Exception as e:
+            logging.error(f"Streaming error during response generation: {e}")
+            error_message = str(e)
+    sent_ok = await safe_send_text(websocket, dumps({"type": "error", "data": error_message}))
+    if not sent_ok:
+        logger.warning("Attempted to send on a closed WebSocket")
+    return ""
+
+
+# Admission control: at most ADMISSION_MAX_INFLIGHT generations run per worker; up to
+# ADMISSION_MAX_QUEUE more wait their turn (with position updates), the rest are shed at once.
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "32"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "20"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+ADMISSION_POSITION_INTERVAL = 1.0
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounded concurrency with a FIFO wait queue; a released slot is handed to the oldest waiter."""
+
+    def __init__(self, max_inflight: int, max_queue: int, queue_timeout: float, retry_after: int):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.inflight = 0
+        self.waiters = deque()
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0,
+                      "peak_inflight": 0, "peak_queue": 0}
+
+    @asynccontextmanager
+    async def slot(self, on_queued=None):
+        """Holds one generation slot. `on_queued(position)` is awaited whenever the queue position changes."""
+        await self.acquire(on_queued)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, on_queued=None):
+        if self.inflight < self.max_inflight and not self.waiters:
+            self._admit()
+            return
+        if len(self.waiters) >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise AdmissionRejected("Server is busy. Please try again shortly.", self.retry_after)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.stats["queued"] += 1
+        self.stats["peak_queue"] = max(self.stats["peak_queue"], len(self.waiters))
+        queued_at = time.monotonic()
+        deadline = queued_at + self.queue_timeout
+        position = None
+        current_span().event("queued", position=len(self.waiters))
+        try:
+            while not waiter.done():
+                if on_queued and waiter in self.waiters and self.waiters.index(waiter) + 1 != position:
+                    position = self.waiters.index(waiter) + 1
+                    await on_queued(position)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats["timed_out"] += 1
+                    raise AdmissionRejected("Server is busy. Please try again shortly.", self.retry_after)
+                await asyncio.wait({waiter}, timeout=min(remaining, ADMISSION_POSITION_INTERVAL))
+        except BaseException:
+            if waiter.done():
+                self.release()  # the slot was handed over just as we gave up; pass it on
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            raise
+        self.stats["admitted"] += 1
+        current_span().event("admitted", waited_ms=round((time.monotonic() - queued_at) * 1000, 1))
+
+    def _admit(self):
+        self.inflight += 1
+        self.stats["admitted"] += 1
+        self.stats["peak_inflight"] = max(self.stats["peak_inflight"], self.inflight)
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # the slot moves to the waiter; inflight is unchanged
+                return
+        self.inflight -= 1
 
-async def get_or_create_session(user_id: str, user_name: str):
-    base_session_key = f"user:{user_id}"
-    session_id = await redis_client.hget(base_session_key, "session_id")
-    if session_id:
-        full_session_key = f"{base_session_key}:{session_id}"
-        conversation_history_str = await redis_client.hget(full_session_key, "conversation_history")
+    def snapshot(self):
+        return {
+            "max_inflight": self.max_inflight,
+            "max_queue": self.max_queue,
+            "queue_timeout_s": self.queue_timeout,
+            "inflight": self.inflight,
+            "queued_now": len(self.waiters),
+            **self.stats,
+        }
+
+
+admission = AdmissionController(ADMISSION_MAX_INFLIGHT, ADMISSION_MAX_QUEUE,
+                                ADMISSION_QUEUE_TIMEOUT, ADMISSION_RETRY_AFTER)
+
+
+# Per-user and per-API-key token buckets, shared by every worker through Redis. One script call
+# refills and charges both buckets atomically, so a message costs one round trip. Sockets must
+# present the API key, so every message is charged against both. Both buckets carry the key's
+# digest as hash tag, which puts all of one key's buckets in a single cluster slot: the price of
+# a global per-key budget checked atomically with the user's.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_USER_CAPACITY = float(os.getenv("RATE_LIMIT_USER_CAPACITY", "10"))
+RATE_LIMIT_USER_REFILL_PER_SEC = float(os.getenv("RATE_LIMIT_USER_REFILL_PER_SEC", "0.2"))
+RATE_LIMIT_KEY_CAPACITY = float(os.getenv("RATE_LIMIT_KEY_CAPACITY", "600"))
+RATE_LIMIT_KEY_REFILL_PER_SEC = float(os.getenv("RATE_LIMIT_KEY_REFILL_PER_SEC", "20"))
+
+# KEYS: the user's bucket hash and the API key's (same slot); ARGV: capacity and refill rate
+# (tokens/s) per key, in the same order. Every bucket is refilled from the server clock; the message is allowed only if each bucket has
+# a token, in which case each is charged one. Returns {allowed, retry_after_ms}.
+TOKEN_BUCKET_LUA = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local levels = {}
+local retry_ms = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+    if tokens < 1 then
+        retry_ms = math.max(retry_ms, math.ceil((1 - tokens) * 1000 / rate))
+    end
+    levels[i] = tokens
+end
+local allowed = 0
+if retry_ms == 0 then allowed = 1 end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - allowed), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(capacity * 1000 / rate) + 1000)
+end
+return {allowed, retry_ms}
+"""
+
+
+class RateLimiter:
+    def __init__(self):
+        self.script = redis_client.register_script(TOKEN_BUCKET_LUA)
+        self.stats = {"allowed": 0, "limited": 0, "errors": 0}
+
+    @staticmethod
+    def bucket_keys(user_id: str, api_key: str):
+        # Keys used by one script call must share a cluster slot, hence the key's digest as tag
+        tag = hashlib.sha1(api_key.encode("utf-8")).hexdigest()[:16]
+        return [f"ratelimit:{{{tag}}}:user:{user_id}", f"ratelimit:{{{tag}}}:apikey"]
+
+    async def check(self, user_id: str, api_key: str):
+        """Returns (allowed, retry_after_seconds). Fails open if Redis is unavailable."""
+        if not RATE_LIMIT_ENABLED:
+            return True, 0
+        args = [RATE_LIMIT_USER_CAPACITY, RATE_LIMIT_USER_REFILL_PER_SEC,
+                RATE_LIMIT_KEY_CAPACITY, RATE_LIMIT_KEY_REFILL_PER_SEC]
         try:
-            conversation_history = json.loads(conversation_history_str) if conversation_history_str else []
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing conversation history: {e}")
-            conversation_history = []
-    else:
-        session_id = str(uuid.uuid4())
-        full_session_key = f"{base_session_key}:{session_id}"
-        conversation_history = []
-        await redis_client.hset(base_session_key, mapping={"session_id": session_id})
-        await redis_client.hset(full_session_key, mapping={
-            "user_id": user_id,
-            "user_name": user_name,
-            "session_id": session_id,
-            "conversation_history": json.dumps(conversation_history),
-        })
-        # Set TTL for the session key (e.g., 24 hours)
-        await redis_client.expire(full_session_key, 86400)
-    return full_session_key, conversation_history
-
-
-async def async_update_session_with_distributed_lock(session_key: str, user_input: str, model_response: str):
-    lock_key = f"lock:{session_key}"
-    for attempt in range(3):  # Try 3 times
-        lock = redis_client.lock(lock_key, timeout=2, sleep=0.1 * (2 ** attempt))
-        acquired = await lock.acquire(blocking=True, blocking_timeout=1)
-        if acquired:
-            try:
-                conversation_history_str = await redis_client.hget(session_key, "conversation_history")
-                try:
-                    conversation_history = json.loads(conversation_history_str) if conversation_history_str else []
-                except json.JSONDecodeError:
-                    logger.error("Error parsing conversation history.")
-                    conversation_history = []
-                conversation_history.extend([
-                    {"role": "user", "content": user_input},
-                    {"role": "assistant", "content": model_response},
-                ])
-                await redis_client.hset(session_key, "conversation_history", json.dumps(conversation_history))
-                logger.info(f"Session {session_key} updated successfully with distributed lock.")
-                return  # Success
-            finally:
-                await lock.release()
-        await asyncio.sleep(0.2 * (2 ** attempt))
-    logger.error("Failed to acquire lock after multiple attempts")
-    raise Exception("Session update failed due to lock contention")
+            with timed(REDIS_LATENCY, operation="rate_limit"):
+                allowed, retry_ms = await self.script(keys=self.bucket_keys(user_id, api_key), args=args,
+                                                      client=redis_client)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Rate limiter unavailable, allowing message for {user_id}: {e}")
+            return True, 0
+        if allowed:
+            self.stats["allowed"] += 1
+            return True, 0
+        self.stats["limited"] += 1
+        return False, max(1, -(-int(retry_ms) // 1000))
+
+
+rate_limiter = RateLimiter()
+
+
+def websocket_api_key(websocket: WebSocket):
+    """The API key a socket presented (Bearer header or `api_key` query parameter), if it is valid."""
+    authorization = websocket.headers.get("authorization", "")
+    token = authorization.split(" ")[1] if authorization.startswith("Bearer ") else None
+    token = token or websocket.query_params.get("api_key")
+    return token if token and token == API_KEY else None
+
+
+# Sliding TTL: the user pointer, session hash and history are refreshed on every activity
+# (session start, WebSocket connect, each appended turn), so only idle sessions expire.
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+
+# Key schema version 2. Every key of one user carries the user id as a cluster hash tag, so all
+# of them live in one slot and a session operation is a single script call on a single node:
+#   user:{<id>}                        pointer hash: session_id, schema_version
+#   user:{<id>}:<session_id>           session hash: user fields, history summary
+#   user:{<id>}:<session_id>:history   history list, one entry per message
+#   summary-refresh:user:{<id>}:...    summary refresh guard
+# Version 1 used the same names without the braces. Those sessions are moved on first use
+# (migrate_legacy_session); migrate_session_keys.py moves the rest and then sets the marker key,
+# after which workers stop looking for version 1 keys.
+SESSION_SCHEMA_VERSION = 2
+SESSION_SCHEMA_MARKER_KEY = "schema:sessions"
+session_schema = {
+    "legacy_check": os.getenv("SESSION_LEGACY_MIGRATION", "true").lower() in ("1", "true", "yes"),
+    "migrated": 0,
+}
+
+# KEYS[1]: the user pointer hash; KEYS[2], KEYS[3]: session hash and history of a new session
+# whose id is ARGV[1]; optionally KEYS[4], KEYS[5]: those of the session this worker last saw
+# for the user, whose id is ARGV[7]. Other ARGV: TTL in seconds, user id, user name, schema
+# version, 1 to read the history.
+# Loads the user's session, or claims the new id if there is none, restores the session fields
+# if the hash expired before the pointer, and refreshes the TTL of all three keys.
+# Returns {session_id, status, has_legacy_history_blob, history entries}; status is 1 when the
+# session was created, 0 when it was loaded, and -1 when the pointer names a session whose keys
+# were not passed, in which case nothing was changed and the caller retries with that id.
+SESSION_BOOTSTRAP_LUA = """
+local session_id = redis.call('HGET', KEYS[1], 'session_id')
+local created = 0
+local session_key, history_key
+if not session_id then
+    session_id = ARGV[1]
+    redis.call('HSET', KEYS[1], 'session_id', session_id, 'schema_version', ARGV[5])
+    created = 1
+    session_key, history_key = KEYS[2], KEYS[3]
+elseif session_id == ARGV[7] then
+    session_key, history_key = KEYS[4], KEYS[5]
+else
+    return {session_id, -1, 0, {}}
+end
+redis.call('HSETNX', session_key, 'user_id', ARGV[3])
+redis.call('HSETNX', session_key, 'user_name', ARGV[4])
+redis.call('HSETNX', session_key, 'session_id', session_id)
+for _, key in ipairs({KEYS[1], session_key, history_key}) do
+    redis.call('EXPIRE', key, ARGV[2])
+end
+local history = {}
+if created == 0 and ARGV[6] == '1' then
+    history = redis.call('LRANGE', history_key, 0, -1)
+end
+return {session_id, created, redis.call('HEXISTS', session_key, 'conversation_history'), history}
+"""
+
+# KEYS: history list, session hash, user pointer. ARGV: user message, assistant message, TTL.
+# Appends one turn and slides the TTL of the whole session in one atomic step.
+SESSION_APPEND_LUA = """
+redis.call('RPUSH', KEYS[1], ARGV[1], ARGV[2])
+for _, key in ipairs(KEYS) do
+    redis.call('EXPIRE', key, ARGV[3])
+end
+return 1
+"""
+
+# KEYS[1]: the user pointer hash; KEYS[2], KEYS[3]: session hash and history of the session
+# it was read to name, whose id is ARGV[1] ("" and no other keys if it named none).
+# Deletes the three keys together. Returns 1, 0 if the user has no session, or -1 if the pointer
+# changed since it was read (nothing deleted).
+SESSION_END_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if (redis.call('HGET', KEYS[1], 'session_id') or '') ~= ARGV[1] then
+    return -1
+end
+redis.call('DEL', unpack(KEYS))
+return 1
+"""
+
+session_bootstrap = redis_client.register_script(SESSION_BOOTSTRAP_LUA)
+session_append = redis_client.register_script(SESSION_APPEND_LUA)
+session_end = redis_client.register_script(SESSION_END_LUA)
+
+# Session id last seen per user by this worker, so the bootstrap script can be passed the
+# session's keys up front; a stale entry only costs a second script call
+SESSION_ID_CACHE_SIZE = 10000
+_known_session_ids = OrderedDict()
+
+
+def user_key(user_id: str) -> str:
+    return f"user:{{{user_id}}}"
+
+
+def legacy_user_key(user_id: str) -> str:
+    # Schema version 1 pointer key, no hash tag
+    return f"user:{user_id}"
+
+
+def legacy_pointer_user_id(key: str):
+    """The user id if `key` is a schema version 1 pointer (user:<id>), otherwise None."""
+    prefix, _, user_id = key.partition(":")
+    if prefix != "user" or not user_id or ":" in user_id or "{" in user_id:
+        return None
+    return user_id
+
+
+def history_key(session_key: str) -> str:
+    # Conversation history lives in a Redis list next to the session hash, one entry per message
+    return f"{session_key}:history"
+
+
+def session_pointer_key(session_key: str) -> str:
+    # user:{id}:{session_id} -> user:{id}
+    return session_key.rsplit(":", 1)[0]
+
+
+def session_keys(user_id: str, session_id: str):
+    """The session hash and history keys of one session."""
+    session_key = f"{user_key(user_id)}:{session_id}"
+    return [session_key, history_key(session_key)]
+
+
+def remember_session_id(user_id: str, session_id=None):
+    _known_session_ids.pop(user_id, None)
+    if session_id:
+        _known_session_ids[user_id] = session_id
+        if len(_known_session_ids) > SESSION_ID_CACHE_SIZE:
+            _known_session_ids.popitem(last=False)
+
+
+async def load_session_schema_marker():
+    # Once every version 1 key has been moved, new sessions no longer need to look for one
+    if not session_schema["legacy_check"]:
+        return
+    try:
+        version = await redis_client.get(SESSION_SCHEMA_MARKER_KEY)
+    except Exception as e:
+        logger.warning(f"Could not read the session schema marker, keeping the legacy key check: {e}")
+        return
+    if version and int(version) >= SESSION_SCHEMA_VERSION:
+        session_schema["legacy_check"] = False
+
+
+async def get_or_create_session(user_id: str, user_name: str, load_history: bool = True):
+    """
+    Returns (session_key, conversation_history), creating the session on first use.
+    One script call resolves the session, refreshes the sliding TTL of all its keys and,
+    unless load_history is False, reads the history. A second call is needed when this worker
+    has not seen the user's current session yet.
+    """
+    known_id = _known_session_ids.get(user_id)
+    with timed(REDIS_LATENCY, operation="session_lookup"):
+        for _ in range(3):
+            new_id = str(uuid.uuid4())
+            keys = [user_key(user_id), *session_keys(user_id, new_id)]
+            args = [new_id, SESSION_TTL_SECONDS, user_id, user_name, SESSION_SCHEMA_VERSION, int(load_history)]
+            if known_id:
+                keys += session_keys(user_id, known_id)
+                args.append(known_id)
+            session_id, status, has_legacy_blob, entries = await session_bootstrap(
+                keys=keys, args=args, client=redis_client)
+            if status != -1:
+                break
+            known_id = session_id
+        else:
+            raise RuntimeError(f"Session for {user_id} kept changing during lookup")
+    created = status == 1
+    remember_session_id(user_id, session_id)
+    session_key = f"{user_key(user_id)}:{session_id}"
+    if created and session_schema["legacy_check"]:
+        if await migrate_legacy_session(user_id, session_key):
+            return await get_or_create_session(user_id, user_name, load_history)
+    if has_legacy_blob:
+        # Rare: a session from an older release; reload once its history has been moved
+        await migrate_legacy_conversation_history(session_key)
+        if load_history:
+            return session_key, await async_get_conversation_history(session_key)
+    return session_key, decode_history_entries(session_key, entries)
+
+
+async def migrate_legacy_session(user_id: str, session_key: str) -> bool:
+    """
+    Moves the user's schema version 1 session (if any) into `session_key`, the session just
+    created under the current layout, and deletes the old keys. The old keys hash to other
+    slots, so this is a copy followed by a delete rather than one atomic step; only the caller
+    whose HDEL removes the old pointer's session id performs it.
+    """
+    old_pointer = legacy_user_key(user_id)
+    old_session_id = await redis_client.hget(old_pointer, "session_id")
+    if not old_session_id or not await redis_client.hdel(old_pointer, "session_id"):
+        return False
+    old_session_key = f"{old_pointer}:{old_session_id}"
+    fields = await redis_client.hgetall(old_session_key)
+    entries = await redis_client.lrange(history_key(old_session_key), 0, -1)
+    fields.pop("session_id", None)  # The session keeps its new id
+    if fields or entries:
+        async with redis_client.pipeline() as pipe:
+            if fields:
+                pipe.hset(session_key, mapping=fields)
+            if entries:
+                # LPUSH in reverse keeps the old turns ahead of any turn appended meanwhile
+                pipe.lpush(history_key(session_key), *reversed(entries))
+                pipe.expire(history_key(session_key), SESSION_TTL_SECONDS)
+            await pipe.execute()
+    await redis_client.delete(old_pointer, old_session_key, history_key(old_session_key))
+    session_schema["migrated"] += 1
+    logger.info(f"Moved session {old_session_key} to {session_key} ({len(entries)} history entries).")
+    return True
+
+
+# KEYS: session hash, history list. ARGV: the legacy blob as read, TTL, then the encoded
+# entries newest first. Moves them only if the blob is unchanged (so exactly one caller moves
+# it), pushing to the head so they stay ahead of any turn appended meanwhile, and removes the
+# blob in the same step. Returns 1 if moved.
+LEGACY_HISTORY_MOVE_LUA = """
+if redis.call('HGET', KEYS[1], 'conversation_history') ~= ARGV[1] then
+    return 0
+end
+for i = 3, #ARGV do
+    redis.call('LPUSH', KEYS[2], ARGV[i])
+end
+redis.call('HDEL', KEYS[1], 'conversation_history')
+if #ARGV > 2 then
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+end
+return 1
+"""
+
+legacy_history_move = redis_client.register_script(LEGACY_HISTORY_MOVE_LUA)
+
+
+async def migrate_legacy_conversation_history(session_key: str) -> bool:
+    """
+    Moves history stored by older releases as a JSON blob in the session hash
+    (`conversation_history` field) into the append-only list. The blob is parsed here and
+    moved by one script call, so a failure part-way leaves it in place for the next attempt.
+    """
+    legacy_history_str = await redis_client.hget(session_key, "conversation_history")
+    if legacy_history_str is None:
+        return False
+    try:
+        legacy_history = loads(legacy_history_str) if legacy_history_str else []
+    except JSONDecodeError as e:
+        logger.error(f"Dropping unparsable legacy conversation history for {session_key}: {e}")
+        legacy_history = []
+    moved = await legacy_history_move(
+        keys=[session_key, history_key(session_key)],
+        args=[legacy_history_str, SESSION_TTL_SECONDS, *[dumps(entry) for entry in reversed(legacy_history)]],
+        client=redis_client)
+    if not moved:
+        return False  # Another worker migrated this session
+    logger.info(f"Migrated {len(legacy_history)} legacy history entries for {session_key}.")
+    return True
+
+
+async def async_append_conversation_turn(session_key: str, user_input: str, model_response: str):
+    # A single RPUSH appends both messages atomically, so no lock and no read-modify-write
+    keys = [history_key(session_key), session_key, session_pointer_key(session_key)]
+    with timed(REDIS_LATENCY, operation="history_append"):
+        await session_append(
+            keys=keys,
+            args=[dumps({"role": "user", "content": user_input}),
+                  dumps({"role": "assistant", "content": model_response}), SESSION_TTL_SECONDS],
+            client=redis_client)
+    logger.info(f"Session {session_key} history appended.")
 
 
 async def async_get_conversation_history(session_key: str):
-    conversation_history_str = await redis_client.hget(session_key, "conversation_history")
+    entries = await redis_client.lrange(history_key(session_key), 0, -1)
+    return decode_history_entries(session_key, entries)
+
+
+def decode_history_entries(session_key: str, entries):
+    conversation_history = []
+    for entry in entries:
+        try:
+            conversation_history.append(loads(entry))
+        except JSONDecodeError as e:
+            logger.error(f"Skipping unparsable history entry in {session_key}: {e}")
+    return conversation_history
+
+
+# History window sent to the model: the last HISTORY_MAX_TURNS turns verbatim, trimmed to
+# HISTORY_TOKEN_BUDGET; anything older is folded into a rolling summary in the session hash.
+# Older messages the summary does not cover yet stay verbatim until it catches up.
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "10"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_SUMMARY_TRIGGER = int(os.getenv("HISTORY_SUMMARY_TRIGGER", "6"))
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "claude-3-5-haiku-20241022")
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "600"))
+
+_summary_tasks = {}
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting English chat text
+    return len(text) // 4 + 1
+
+
+async def async_get_history_window(session_key: str):
+    """
+    Returns (window, summary): every message after the rolling summary's boundary and the
+    summary itself, so no message is in both or in neither. Schedules a background summary
+    refresh when enough of the window lies beyond the most recent messages that fit the
+    token budget; until it lands those messages stay in the window verbatim.
+    """
+    with timed(REDIS_LATENCY, operation="history_window"):
+        async with redis_client.pipeline() as pipe:
+            pipe.llen(history_key(session_key))
+            pipe.lrange(history_key(session_key), -2 * HISTORY_MAX_TURNS, -1)
+            pipe.hmget(session_key, ["history_summary", "history_summarized_count"])
+            total, entries, (summary, summarized_count) = await pipe.execute()
+        summarized_count = int(summarized_count or 0)
+        window_start = total - len(entries)
+        if summarized_count < window_start:
+            # The summary is behind the recent turns; fetch the messages in between as well.
+            # History is append-only, so these indexes still point at the same entries.
+            entries = await redis_client.lrange(history_key(session_key), summarized_count,
+                                                window_start - 1) + entries
+            window_start = summarized_count
+    # Never repeat what the summary already covers
+    entries = entries[max(summarized_count - window_start, 0):]
+
+    messages = []
+    for entry in entries:
+        try:
+            messages.append(loads(entry))
+        except JSONDecodeError as e:
+            logger.error(f"Skipping unparsable history entry in {session_key}: {e}")
+            messages.append(None)
+
+    # The newest messages that fit the budget, always including the last turn, stay verbatim;
+    # the ones before them are due to be summarized
+    verbatim = tokens = 0
+    for message in reversed(messages[-2 * HISTORY_MAX_TURNS:]):
+        tokens += estimate_tokens(message.get("content") or "") if message else 0
+        if verbatim >= 2 and tokens > HISTORY_TOKEN_BUDGET:
+            break
+        verbatim += 1
+    summarize_upto = total - verbatim
+    if summarize_upto - summarized_count >= HISTORY_SUMMARY_TRIGGER:
+        schedule_history_summary(session_key, summarize_upto)
+    return [m for m in messages if m is not None], summary or None
+
+
+def schedule_history_summary(session_key: str, upto: int):
+    # One refresh per session at a time in this worker; the Redis guard covers other workers
+    if session_key in _summary_tasks:
+        return
+    task = asyncio.create_task(refresh_history_summary(session_key, upto))
+    _summary_tasks[session_key] = task
+    task.add_done_callback(lambda _: _summary_tasks.pop(session_key, None))
+
+
+# KEYS[1]: session hash. ARGV: summary, number of messages it covers, TTL. Stores the summary
+# only if the session still exists, so a refresh finishing after the session ended or expired
+# cannot recreate the hash without a TTL. Returns 1 if stored.
+SUMMARY_STORE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'history_summary', ARGV[1], 'history_summarized_count', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+summary_store = redis_client.register_script(SUMMARY_STORE_LUA)
+
+
+async def refresh_history_summary(session_key: str, upto: int):
+    """Folds history entries [history_summarized_count, upto) into the session's rolling summary."""
+    guard_key = f"summary-refresh:{session_key}"
     try:
-        return json.loads(conversation_history_str) if conversation_history_str else []
-    except json.JSONDecodeError as e:
-        logger.error(f"Error parsing conversation history: {e}")
-        return []
+        if not await redis_client.set(guard_key, "1", nx=True, ex=120):
+            return
+        try:
+            summary, summarized_count = await redis_client.hmget(
+                session_key, ["history_summary", "history_summarized_count"])
+            summarized_count = int(summarized_count or 0)
+            if summarized_count >= upto:
+                return
+            entries = await redis_client.lrange(history_key(session_key), summarized_count, upto - 1)
+            transcript = "\n".join(
+                f"{m.get('role')}: {m.get('content')}" for m in (loads(e) for e in entries)
+            )
+            response = await claude_client.messages.create(
+                model=HISTORY_SUMMARY_MODEL,
+                max_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+                temperature=0,
+                system=(
+                    "You maintain a running summary of a nutrition chat between a user and the assistant Faye. "
+                    "Merge the new messages into the existing summary. Keep facts the user shared about "
+                    "themselves, foods discussed, advice given and open questions. Plain text, at most 200 words."
+                ),
+                messages=[{
+                    "role": "user",
+                    "content": f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}",
+                }],
+            )
+            new_summary = "".join(block.text for block in response.content if getattr(block, "text", None))
+            if not await summary_store(keys=[session_key], args=[new_summary, upto, SESSION_TTL_SECONDS],
+                                       client=redis_client):
+                logger.info(f"Session {session_key} ended before its history summary was stored.")
+                return
+            logger.info(f"History summary for {session_key} now covers {upto} messages.")
+        finally:
+            await redis_client.delete(guard_key)
+    except Exception as e:
+        logger.warning(f"History summary refresh failed for {session_key}: {e}")
+
+
+# Cross-worker delivery: every worker subscribes to `ws:user:<id>` for the users whose sockets it
+# holds, so send_message can reach a user connected to any worker or node through PUBLISH.
+# Which workers hold a user is tracked explicitly, since a PUBLISH reply only counts the
+# subscribers on the node that received it: `user:{<id>}:workers` is a sorted set of worker ids
+# scored by when each entry expires, refreshed while the worker's delivery listener is subscribed.
+WORKER_ID = uuid.uuid4().hex
+DELIVERY_CHANNEL_PREFIX = "ws:user:"
+PRESENCE_TTL_SECONDS = int(os.getenv("PRESENCE_TTL_SECONDS", "30"))
+PRESENCE_REFRESH_INTERVAL = PRESENCE_TTL_SECONDS / 3
+PRESENCE_CHECK_INTERVAL = 1.0  # how long a streaming answer reuses one presence lookup
+
+
+def presence_key(user_id: str) -> str:
+    return f"{user_key(user_id)}:workers"
 
 
 class ConnectionManager:
+    """
+    Registry of open sockets: user_id -> {connection_id: websocket}, so a user can be connected
+    from several devices at once. Register and unregister are O(1) dict operations that never
+    await in between, so the event loop needs no lock; sends iterate over a snapshot.
+
+    It also holds each user's generation in flight on this worker (user_id -> task). The user's
+    sockets share it: a stop or a new message from any device replaces it, and it is cancelled
+    on disconnect only when the user's last socket here goes away.
+    """
+
     def __init__(self):
         self.active_connections = {}
-        self.lock = asyncio.Lock()
+        self.generations = {}
+        self.connection_count = 0
+        self.pubsub = None  # set while the delivery listener is connected
+        self.stats = {"local": 0, "published": 0, "relayed": 0, "undelivered": 0}
 
-    async def connect(self, websocket: WebSocket, user_id: str):
+    async def connect(self, websocket: WebSocket, user_id: str) -> str:
+        """Accepts and registers the socket; returns its connection id for disconnect()."""
         await websocket.accept()
-        async with self.lock:
-            self.active_connections[user_id] = websocket
-
-    async def disconnect(self, user_id: str):
-        async with self.lock:
-            self.active_connections.pop(user_id, None)
-
-    async def send_message(self, user_id: str, message: dict):
-        async with self.lock:
-            websocket = self.active_connections.get(user_id)
-        if websocket:
-            # Use safe_send_json directly, to ensure we handle a closed socket.
-            sent_ok = await safe_send_json(websocket, message)
-            if not sent_ok:
-                logger.warning(f"WebSocket for user_id {user_id} is closed; message not delivered.")
-                # Decide whether to return, log only, or do something else.
+        connection_id = uuid.uuid4().hex
+        devices = self.active_connections.setdefault(user_id, {})
+        devices[connection_id] = websocket
+        self.connection_count += 1
+        ACTIVE_WEBSOCKETS.set(self.connection_count)
+        if len(devices) == 1:
+            await self._subscribe(user_id)
+        return connection_id
+
+    async def disconnect(self, user_id: str, connection_id: str):
+        devices = self.active_connections.get(user_id)
+        if not devices or devices.pop(connection_id, None) is None:
+            return
+        self.connection_count -= 1
+        ACTIVE_WEBSOCKETS.set(self.connection_count)
+        if not devices:
+            del self.active_connections[user_id]
+            await cancel_generation(self.generations.get(user_id), "disconnect")
+            await self._unsubscribe(user_id)
+            if user_id in self.active_connections:
+                await self._subscribe(user_id)  # a device connected while we were unsubscribing
+            else:
+                await self._clear_presence([user_id])
+
+    def devices(self, user_id: str):
+        return list(self.active_connections.get(user_id, {}).values())
+
+    async def start_generation(self, user_id: str, coro):
+        """Cancels the user's answer in flight, if any, and runs `coro` as the new one."""
+        # Loop because another device's message may have started one while we waited
+        while (task := self.generations.get(user_id)) is not None and not task.done():
+            await cancel_generation(task, "new_message")
+        task = asyncio.create_task(coro)
+        self.generations[user_id] = task
+
+        def forget(done):
+            if self.generations.get(user_id) is done:
+                del self.generations[user_id]
+
+        task.add_done_callback(forget)
+        return task
+
+    async def stop_generation(self, user_id: str):
+        await cancel_generation(self.generations.get(user_id), "stop")
+
+    async def send_local(self, user_id: str, text: str) -> int:
+        """Writes `text` to every socket this worker holds for the user; returns how many took it."""
+        sockets = self.devices(user_id)
+        if len(sockets) == 1:
+            return int(await safe_send_text(sockets[0], text))
+        results = await asyncio.gather(*(safe_send_text(ws, text) for ws in sockets))
+        return sum(results)
+
+    async def remote_present(self, user_id: str) -> bool:
+        """Whether another worker currently holds a socket for the user."""
+        try:
+            workers = await redis_client.zrangebyscore(presence_key(user_id), time.time(), "+inf")
+        except Exception as e:
+            # Publish anyway: a wasted PUBLISH is cheaper than a dropped message
+            logger.warning(f"Presence lookup failed for user_id {user_id}: {e}")
+            return True
+        return any(worker != WORKER_ID for worker in workers)
+
+    async def publish(self, user_id: str, text: str) -> bool:
+        """Publishes `text` for the user's sockets on other workers; returns False if Redis refused it."""
+        try:
+            await redis_client.publish(DELIVERY_CHANNEL_PREFIX + user_id,
+                                       dumps({"origin": WORKER_ID, "text": text}))
+        except Exception as e:
+            logger.warning(f"Could not publish message for user_id {user_id}: {e}")
+            return False
+        return True
+
+    async def send_message(self, user_id: str, message: dict) -> bool:
+        """
+        Delivers `message` to every device of the user, on any worker. Returns False if no
+        worker had the user connected.
+        """
+        text = dumps(message)
+        local = await self.send_local(user_id, text)
+        remote = await self.remote_present(user_id) and await self.publish(user_id, text)
+        if local:
+            self.stats["local"] += 1
+        if remote:
+            self.stats["published"] += 1
+        if not local and not remote:
+            self.stats["undelivered"] += 1
+            return False
+        return True
+
+    async def _subscribe(self, user_id: str):
+        if self.pubsub is not None:
+            try:
+                await self.pubsub.subscribe(DELIVERY_CHANNEL_PREFIX + user_id)
+            except Exception as e:
+                # The listener resubscribes every local user when it reconnects
+                logger.warning(f"Delivery subscribe failed for user_id {user_id}: {e}")
                 return
+            if user_id in self.active_connections:  # not already gone again
+                await self._mark_present([user_id])
+
+    async def _unsubscribe(self, user_id: str):
+        if self.pubsub is not None:
+            try:
+                await self.pubsub.unsubscribe(DELIVERY_CHANNEL_PREFIX + user_id)
+            except Exception as e:
+                logger.warning(f"Delivery unsubscribe failed for user_id {user_id}: {e}")
+
+    async def _mark_present(self, user_ids):
+        """Registers this worker for `user_ids` for the next PRESENCE_TTL_SECONDS."""
+        now = time.time()
+        try:
+            async with redis_client.pipeline() as pipe:
+                for user_id in user_ids:
+                    key = presence_key(user_id)
+                    pipe.zadd(key, {WORKER_ID: now + PRESENCE_TTL_SECONDS})
+                    pipe.zremrangebyscore(key, "-inf", now)  # workers that died without leaving
+                    pipe.expire(key, PRESENCE_TTL_SECONDS)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Presence update failed for {len(user_ids)} user(s): {e}")
+
+    async def _clear_presence(self, user_ids):
+        try:
+            async with redis_client.pipeline() as pipe:
+                for user_id in user_ids:
+                    pipe.zrem(presence_key(user_id), WORKER_ID)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Presence removal failed for {len(user_ids)} user(s): {e}")
+
+    async def run_presence_refresh(self):
+        """Keeps this worker's presence entries alive while its delivery listener is subscribed."""
+        while True:
+            await asyncio.sleep(PRESENCE_REFRESH_INTERVAL)
+            if self.pubsub is not None and self.active_connections:
+                await self._mark_present(list(self.active_connections))
+
+    async def _relay(self, channel: str, data: str):
+        payload = loads(data)
+        if payload.get("origin") == WORKER_ID:
+            return  # already written to the local sockets by the sender
+        if await self.send_local(channel[len(DELIVERY_CHANNEL_PREFIX):], payload["text"]):
+            self.stats["relayed"] += 1
+
+    async def run_delivery_listener(self):
+        """Relays messages published for locally connected users; reconnects on failure."""
+        while True:
+            pubsub_conn = get_pubsub_connection()
+            try:
+                async with pubsub_conn.pubsub() as pubsub:
+                    # A per-worker channel keeps the subscription alive while no user is connected
+                    await pubsub.subscribe(f"ws:worker:{WORKER_ID}")
+                    local_users = list(self.active_connections)
+                    if local_users:
+                        await pubsub.subscribe(*[DELIVERY_CHANNEL_PREFIX + u for u in local_users])
+                        await self._mark_present(local_users)
+                    self.pubsub = pubsub
+                    async for message in pubsub.listen():
+                        if message.get("type") != "message" or not message["channel"].startswith(
+                                DELIVERY_CHANNEL_PREFIX):
+                            continue
+                        try:
+                            await self._relay(message["channel"], message["data"])
+                        except (JSONDecodeError, KeyError, TypeError) as e:
+                            logger.warning(f"Ignoring malformed delivery message: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Delivery listener error: {e}; reconnecting in 5s")
+                self.pubsub = None
+                # Until it is back, other workers should not count on this one to relay
+                await self._clear_presence(list(self.active_connections))
+                await asyncio.sleep(5)
+            finally:
+                self.pubsub = None
+                await pubsub_conn.aclose()
 
 
 manager = ConnectionManager()
 
 
+class UserFanout:
+    """
+    Passed to generate_response in place of the requesting socket, so every frame of the answer
+    reaches all of the user's devices. Frames are also published while presence shows the user
+    on another worker, rechecked every PRESENCE_CHECK_INTERVAL so a device that connects there
+    mid-answer starts receiving it.
+    """
+
+    def __init__(self, connections: ConnectionManager, user_id: str):
+        self.connections = connections
+        self.user_id = user_id
+        self.remote = False
+        self.checked_at = None
+
+    async def send_text(self, text: str):
+        delivered = await self.connections.send_local(self.user_id, text)
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= PRESENCE_CHECK_INTERVAL:
+            self.remote = await self.connections.remote_present(self.user_id)
+            self.checked_at = now
+        if self.remote and await self.connections.publish(self.user_id, text):
+            delivered += 1
+        if not delivered:
+            # Surfaces like a closed socket, so safe_send_text reports False and the relay stops
+            raise RuntimeError(f"No connected device for user_id {self.user_id}")
+
+
 @app.post("/chat/start_session")
 async def start_session(
         request: StartSessionRequest,
@@ -680,47 +2525,125 @@ async def start_session(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def parse_control_message(raw_message: str):
+    """Returns the control type of a `{"type": "stop"}` style message, or None for chat text."""
+    if not raw_message.startswith("{"):
+        return None
+    try:
+        message = loads(raw_message)
+    except JSONDecodeError:
+        return None
+    if isinstance(message, dict) and message.get("type") == "stop":
+        return "stop"
+    return None
+
+
+async def cancel_generation(task, reason: str):
+    """Cancels an in-flight generation and waits for its upstream stream to be closed."""
+    if task is None or task.done():
+        return
+    if not task.cancelling():  # another device's request may already be cancelling it
+        cancel_stats["cancelled"] += 1
+        cancel_stats[reason] += 1
+        logger.info(f"Cancelling generation in flight ({reason})")
+        task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
+    # The key is required so every message is charged against the per-key rate limit as well
+    api_key = websocket_api_key(websocket)
+    if api_key is None:
+        await websocket.close(code=1008, reason="Unauthorized API Key")
+        return
+    connection_id = await manager.connect(websocket, user_id)
     try:
         # Retrieve or create the session
-        session_key, _ = await get_or_create_session(user_id, "WebSocket User")
+        session_key, _ = await get_or_create_session(user_id, "WebSocket User", load_history=False)
 
-        while True:
-            # Receive message from the client (all messages are treated as plain text)
-            raw_message = await websocket.receive_text()
-            user_input = raw_message
+        async def send_queue_position(position):
+            await safe_send_text(websocket, dumps({"type": "queued", "data": {"position": position}}))
 
-            logger.info(f"Processed message - user_id: {user_id}, user_input: {user_input}")
+        async def run_turn(user_input):
+            with tracer.span("chat.message", user_id=user_id, session_key=session_key) as span:
+                await process_turn(user_input, span)
 
+        async def process_turn(user_input, span):
             try:
-                # Process the text message
-                response = await generate_response(user_input, session_key, user_id, websocket)
+                # Process the text message once the worker has capacity for another generation
+                async with admission.slot(on_queued=send_queue_position):
+                    with tracer.span("generate_response"):
+                        response = await generate_response(user_input, session_key, user_id,
+                                                           UserFanout(manager, user_id))
+                span.set(input_tokens_estimate=estimate_tokens(user_input),
+                         output_tokens_estimate=estimate_tokens(response) if response else 0)
+                if not response:
+                    # The client already got an error frame; a failed turn is not part of the conversation
+                    span.set(saved=False)
+                    return
                 # Update session with the conversation
-                await async_update_session_with_distributed_lock(session_key, user_input, response)
-
+                with tracer.span("session.append"):
+                    await async_append_conversation_turn(session_key, user_input, response)
+            except AdmissionRejected as e:
+                span.set(rejected=str(e))
+                logger.warning(f"Shedding message for user_id: {user_id} - {e}")
+                await safe_send_text(websocket, dumps({
+                    "type": "error",
+                    "data": str(e),
+                    "retry_after": e.retry_after
+                }))
             except Exception as e:
                 logger.error(f"Error processing message for user_id: {user_id} - {e}")
-                sent_ok = await safe_send_text(websocket, json.dumps({
+                sent_ok = await safe_send_text(websocket, dumps({
                     "type": "error",
                     "data": str(e)
                 }))
                 if not sent_ok:
                     logger.warning("Attempted to send on a closed WebSocket")
-                break
+
+        # Generation runs as a task so the socket keeps being read: a "stop" control message or a
+        # newer message from any of the user's devices cancels the answer in flight, and so does
+        # the disconnect of the user's last socket on this worker
+        try:
+            while True:
+                raw_message = await websocket.receive_text()
+                if parse_control_message(raw_message) == "stop":
+                    await manager.stop_generation(user_id)
+                    continue
+                # Rate limiting happens before any profile, vector or LLM work is started
+                allowed, retry_after = await rate_limiter.check(user_id, api_key)
+                if not allowed:
+                    logger.warning(f"Rate limited message for user_id: {user_id}")
+                    await safe_send_text(websocket, dumps({
+                        "type": "error",
+                        "data": "Too many messages. Please slow down.",
+                        "retry_after": retry_after
+                    }))
+                    continue
+                # Anything that is not a control message is the user's text
+                user_input = raw_message
+
+                logger.info(f"Processed message - user_id: {user_id}, user_input: {user_input}")
+                await manager.start_generation(user_id, run_turn(user_input))
+        finally:
+            await manager.disconnect(user_id, connection_id)
 
     except WebSocketDisconnect:
-        await manager.disconnect(user_id)
+        await manager.disconnect(user_id, connection_id)
         logger.info(f"WebSocket disconnected for user_id: {user_id}")
     except Exception as e:
         logger.error(f"Unexpected error in WebSocket for user_id: {user_id} - {e}")
-        sent_ok = await safe_send_text(websocket, json.dumps({
+        sent_ok = await safe_send_text(websocket, dumps({
             "type": "error",
             "data": "Connection error. Please refresh and try again."
         }))
         if not sent_ok:
             logger.warning("Attempted to send on a closed WebSocket")
+        await manager.disconnect(user_id, connection_id)
         await websocket.close()
 
 
@@ -728,13 +2651,17 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
 async def end_session(request: EndSessionRequest):
     user_id = request.user_id
     try:
-        session_key = f"user:{user_id}"
-        if await redis_client.exists(session_key):
-            session_id = await redis_client.hget(session_key, "session_id")
-            if session_id:
-                full_session_key = f"{session_key}:{session_id}"
-                await redis_client.delete(full_session_key)
-            await redis_client.delete(session_key)
+        remember_session_id(user_id)
+        for _ in range(3):
+            session_id = await redis_client.hget(user_key(user_id), "session_id")
+            keys = [user_key(user_id), *(session_keys(user_id, session_id) if session_id else [])]
+            ended = await session_end(keys=keys, args=[session_id or ""], client=redis_client)
+            if ended != -1:
+                break
+        ended = ended == 1
+        if session_schema["legacy_check"]:
+            ended = await end_legacy_session(user_id) or ended
+        if ended:
             return {"message": "Session ended successfully"}
         return JSONResponse(content={"error": "No active session found"}, status_code=404)
     except Exception as e:
@@ -742,6 +2669,95 @@ async def end_session(request: EndSessionRequest):
         return JSONResponse(content={"error": "Internal Server Error"}, status_code=500)
 
 
+async def end_legacy_session(user_id: str) -> bool:
+    # A schema version 1 session that was never used since the key layout changed
+    old_pointer = legacy_user_key(user_id)
+    session_id = await redis_client.hget(old_pointer, "session_id")
+    keys = [old_pointer]
+    if session_id:
+        keys += [f"{old_pointer}:{session_id}", history_key(f"{old_pointer}:{session_id}")]
+    return bool(await redis_client.delete(*keys))
+
+
+@app.post("/chat/push")
+async def push_message(
+        request: PushMessageRequest,
+        token: str = Depends(validate_api_key)
+):
+    # Server-initiated message (reminder, async result) to a user connected to any worker
+    try:
+        delivered = await manager.send_message(request.user_id, {"type": "push", "data": request.data})
+        if not delivered:
+            return JSONResponse(content={"error": "User is not connected"}, status_code=404)
+        return {"message": "Delivered", "user_id": request.user_id}
+    except Exception as e:
+        logger.error(f"Unexpected error in push_message: {e}")
+        return JSONResponse(content={"error": "Internal Server Error"}, status_code=500)
+
+
+@app.post("/chat/invalidate_profile")
+async def invalidate_profile(
+        request: InvalidateProfileRequest,
+        token: str = Depends(validate_api_key)
+):
+    # Called by the profile service after an edit so the next message sees the new profile
+    try:
+        await profile_cache.invalidate(request.user_id)
+        return {"message": "Profile cache invalidated", "user_id": request.user_id}
+    except Exception as e:
+        logger.error(f"Unexpected error in invalidate_profile: {e}")
+        return JSONResponse(content={"error": "Internal Server Error"}, status_code=500)
+
+
+@app.get("/chat/cache_stats")
+async def cache_stats(token: str = Depends(validate_api_key)):
+    # Counters are per worker process
+    return {
+        name: {**cache.stats, **cache.flight.stats, "local_size": len(cache.local)}
+        for name, cache in CACHES.items()
+    }
+
+
+@app.get("/chat/stream_stats")
+async def get_stream_stats(token: str = Depends(validate_api_key)):
+    # Per worker process, since the worker started
+    elapsed = max(time.time() - stream_stats["started_at"], 1e-9)
+    return {
+        "deltas": stream_stats["deltas"],
+        "frames": stream_stats["frames"],
+        "bytes": stream_stats["bytes"],
+        "frames_per_sec": round(stream_stats["frames"] / elapsed, 3),
+        "bytes_per_sec": round(stream_stats["bytes"] / elapsed, 3),
+        "deltas_per_frame": round(stream_stats["deltas"] / max(stream_stats["frames"], 1), 3),
+        "failovers": stream_stats["failovers"],
+        "failovers_failed": stream_stats["failovers_failed"],
+        "cancellation": cancel_stats,
+        "hedging": get_hedge_stats(),
+    }
+
+
+@app.get("/metrics")
+async def metrics(token: str = Depends(validate_api_key)):
+    # Prometheus exposition; under gunicorn this aggregates every worker
+    payload, content_type = render_metrics()
+    return Response(content=payload, media_type=content_type)
+
+
+@app.get("/chat/admission_stats")
+async def admission_stats(token: str = Depends(validate_api_key)):
+    # Per worker process: configured limits, current load and shed counts
+    return {**admission.snapshot(), "rate_limit": rate_limiter.stats, "tracing": tracer.stats,
+            "delivery": {**manager.stats, "users": len(manager.active_connections),
+                         "connections": manager.connection_count},
+            "sessions": session_schema}
+
+
+@app.get("/chat/provider_health")
+async def provider_health(token: str = Depends(validate_api_key)):
+    # Breaker state per provider; windows are cluster-wide once synced from Redis
+    return provider_router.snapshot()
+
+
 @app.get("/")
 async def home():
     return {"message": "Chatbot FastAPI server is running!"}
@@ -0,0 +1,69 @@
+"""
+Prometheus metrics for the chat pipeline, served at /metrics.
+
+Under gunicorn every worker is a separate process with its own counters. When
+PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it before workers fork) each worker
+writes its samples to files in that directory and /metrics aggregates all of them, so any
+worker can answer a scrape. Without it (plain uvicorn) the default in-process registry is used.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+)
+from prometheus_client import multiprocess
+
+# Streams take seconds, so the buckets reach well past the default 10s
+_LLM_BUCKETS = (0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 8, 13, 20, 30, 60)
+_IO_BUCKETS = (0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "chat_llm_time_to_first_token_seconds", "Time from request to first streamed token",
+    ["provider"], buckets=_LLM_BUCKETS,
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "chat_llm_tokens_per_second", "Streaming rate after the first token (estimated tokens)",
+    ["provider"], buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 300),
+)
+LLM_STREAMS = Counter(
+    "chat_llm_streams_total", "Provider streams by outcome", ["provider", "outcome"],
+)
+LLM_FALLBACKS = Counter(
+    "chat_llm_fallbacks_total",
+    "Answers served by another provider: before the first token, mid-stream, by a hedge, or breaker_open "
+    "(the provider was skipped because its circuit breaker is open)",
+    ["kind", "from_provider"],
+)
+UPSTREAM_LATENCY = Histogram(
+    "chat_upstream_request_seconds", "HTTP latency of context lookups", ["upstream", "status"],
+    buckets=_IO_BUCKETS,
+)
+REDIS_LATENCY = Histogram(
+    "chat_redis_command_seconds", "Latency of Redis operations on the request path", ["operation"],
+    buckets=_IO_BUCKETS,
+)
+ACTIVE_WEBSOCKETS = Gauge(
+    "chat_active_websockets", "Open chat WebSocket connections", multiprocess_mode="livesum",
+)
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """Observes the duration of the block on `histogram`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+
+def render_metrics():
+    """Returns (payload, content_type) for the /metrics endpoint."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
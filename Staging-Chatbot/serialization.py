@@ -0,0 +1,47 @@
+"""
+Serialization used for every WebSocket frame and every Redis payload.
+
+orjson (pinned in requirements.txt) is several times faster than the stdlib json module.
+The helpers return str because Starlette's send_text and the Redis client
+(decode_responses=True) both work with text.
+"""
+import orjson
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so existing handlers keep working
+JSONDecodeError = orjson.JSONDecodeError
+
+_OPTIONS = orjson.OPT_NON_STR_KEYS
+_SORTED_OPTIONS = _OPTIONS | orjson.OPT_SORT_KEYS
+
+
+def dumps(obj, sort_keys: bool = False, lenient: bool = False) -> str:
+    """
+    Raises TypeError for values JSON can't represent. `lenient` encodes them with str()
+    instead; only for output that is never read back (fingerprints, trace exports).
+    """
+    return orjson.dumps(obj, default=str if lenient else None,
+                        option=_SORTED_OPTIONS if sort_keys else _OPTIONS).decode()
+
+
+def loads(data):
+    return orjson.loads(data)
+
+
+class FrameTemplate:
+    """
+    A WebSocket frame with its fixed fields (`message_id`, `type`) encoded once.
+    Each render only encodes the `data` value, which is all that changes per delta.
+    """
+
+    __slots__ = ("_prefix",)
+
+    def __init__(self, frame_type: str, message_id=None):
+        self._prefix = '{"message_id":' + dumps(message_id) + ',"type":' + dumps(frame_type) + ',"data":'
+
+    def render(self, data) -> str:
+        return self._prefix + dumps(data) + "}"
+
+
+def frame(frame_type: str, data, message_id=None) -> str:
+    """Encodes a one-off frame that carries a message_id (message_start, message_stop)."""
+    return FrameTemplate(frame_type, message_id).render(data)
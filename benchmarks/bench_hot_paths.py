@@ -0,0 +1,232 @@
+"""
+Microbenchmarks for the CPU-bound parts of a chat turn:
+
+- build_prompt with realistic profiles and long histories (profile block memoized and cold)
+- transform_user_profile over small and large OpenSearch `_source` documents
+- history entry encode/decode at 10/100/1000 turns, as stored in the Redis list
+- per-delta `streaming` frame serialization
+- query normalization for the vector cache key
+
+Inputs are generated from a fixed seed, so runs are comparable. Results (median and best
+ns/op over several repeats, plus commit and interpreter details) are written as JSON; pass a
+previous file to --compare to flag regressions. Run offline from the repository root:
+
+    python benchmarks/bench_hot_paths.py [--app-dir Production-Chatbot] [--output results.json]
+    python benchmarks/bench_hot_paths.py --compare benchmarks/results/hot_paths-<commit>.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED = 1234
+WORDS = ("almond", "oat", "fibre", "lentil", "salmon", "olive", "cholesterol", "portion", "daily",
+         "protein", "spinach", "walnut", "bean", "balanced", "meal", "snack", "vitamin", "iron")
+NUTRIENTS = ("Energy", "Protein", "Fats", "Saturated Fat", "Cholesterol", "Sodium", "Carbohydrates",
+             "Dietary Fibre", "Vitamin C", "Calcium", "Iron", "Potassium", "Hydration")
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def ingredient(rng):
+    return {
+        "common_name": rng.choice(WORDS).title(),
+        "relationships": [
+            {"extracts": sentence(rng, 30), "url": f"https://pubmed.example/{rng.randint(1, 10 ** 7)}"}
+            for _ in range(rng.randint(0, 3))
+        ],
+    }
+
+
+def opensearch_source(rng, goals, ingredients_per_goal):
+    return {
+        "name": "Alex Example",
+        "age": 41,
+        "sex": "female",
+        "height": 168,
+        "weight": 64,
+        "ethnicity": {"title": "Mixed"},
+        "user_health_goals": [
+            {
+                "user_goal": {"title": f"Goal {i}: {sentence(rng, 4)}", "is_primary": i == 0},
+                "ingredients_to_recommend": [ingredient(rng) for _ in range(ingredients_per_goal)],
+                "ingredients_to_avoid": [ingredient(rng) for _ in range(ingredients_per_goal // 2)],
+            }
+            for i in range(goals)
+        ],
+        "dietary_restrictions": {"name": "Vegetarian"},
+        "allergens": [{"type": t} for t in ("peanut", "sesame", "shellfish")],
+        "nutrients": {"results": {
+            "macro": [{"nutrition_guideline": {"item": n}, "target_value": rng.randint(10, 2500)}
+                      for n in NUTRIENTS[:7]],
+            "micro": [{"nutrition_guideline": {"item": n}, "target_value": rng.randint(1, 3000)}
+                      for n in NUTRIENTS[7:]],
+        }},
+    }
+
+
+def conversation(rng, turns):
+    messages = []
+    for _ in range(turns):
+        messages.append({"role": "user", "content": sentence(rng, 15)})
+        messages.append({"role": "assistant", "content": "<div><p>" + " ".join(
+            sentence(rng, 20) for _ in range(6)) + "</p></div>"})
+    return messages
+
+
+def vector_results(rng):
+    return {"results": [{"queries": [], "results": [
+        {"text": sentence(rng, 60), "score": round(rng.random(), 3)} for _ in range(10)]}]}
+
+
+def measure(fn, repeats, min_time):
+    """Returns per-op ns for each repeat, with the loop count calibrated to run >= min_time."""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed < min_time / 10 else max(2, int(min_time / max(elapsed, 1e-9)) + 1)
+    samples = [elapsed / loops * 1e9]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        samples.append((time.perf_counter() - start) / loops * 1e9)
+    return samples, loops
+
+
+def build_cases(main, serialization):
+    rng = random.Random(SEED)
+    profile = main.transform_user_profile(opensearch_source(rng, goals=4, ingredients_per_goal=15))
+    vectors = vector_results(rng)
+    query = "Is salmon a good choice for my cholesterol goal?"
+    small_source = opensearch_source(rng, goals=3, ingredients_per_goal=10)
+    large_source = opensearch_source(rng, goals=25, ingredients_per_goal=120)
+    template = serialization.FrameTemplate("streaming", "msg_01XFDUDYJgAACzvnptvVoYEL")
+    delta = "Almonds are rich in monounsaturated fats, "
+
+    def cold_prompt(history):
+        def run():
+            main._profile_instruction_cache.clear()
+            main.build_prompt(query, vectors, history, profile)
+        return run
+
+    cases = {}
+    for turns in (10, 50):
+        history = conversation(rng, turns)
+        cases[f"build_prompt/history_{turns}/memoized_profile"] = (
+            lambda history=history: main.build_prompt(query, vectors, history, profile))
+        cases[f"build_prompt/history_{turns}/cold_profile"] = cold_prompt(history)
+    cases["transform_user_profile/3_goals"] = lambda: main.transform_user_profile(small_source)
+    cases["transform_user_profile/25_goals"] = lambda: main.transform_user_profile(large_source)
+    for turns in (10, 100, 1000):
+        messages = conversation(rng, turns)
+        entries = [serialization.dumps(m) for m in messages]
+        cases[f"history/encode/{turns}_turns"] = lambda messages=messages: [serialization.dumps(m) for m in messages]
+        cases[f"history/decode/{turns}_turns"] = lambda entries=entries: [serialization.loads(e) for e in entries]
+    cases["frame/streaming_delta"] = lambda: template.render(delta)
+    cases["normalize_query"] = lambda: main.normalize_query(query)
+    return cases
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(app_dir, repeats, min_time, only=None):
+    sys.path.insert(0, os.path.join(ROOT, app_dir))
+    logging.disable(logging.CRITICAL)
+    import main
+    import serialization
+
+    results = {}
+    for name, fn in build_cases(main, serialization).items():
+        if only and only not in name:
+            continue
+        samples, loops = measure(fn, repeats, min_time)
+        results[name] = {
+            "median_ns": round(statistics.median(samples), 1),
+            "best_ns": round(min(samples), 1),
+            "loops": loops,
+            "repeats": repeats,
+        }
+    return {
+        "suite": "hot_paths",
+        "commit": git_commit(),
+        "app_dir": app_dir,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "seed": SEED,
+        "results": results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """Prints the change per case; returns the names that got slower than `threshold`."""
+    regressions = []
+    print(f"\ncompared with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            continue
+        change = result["median_ns"] / before["median_ns"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<48}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app-dir", default="Production-Chatbot", help="service directory to import from")
+    parser.add_argument("--repeats", type=int, default=7)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per repeat")
+    parser.add_argument("--only", help="run only cases whose name contains this string")
+    parser.add_argument("--output", help="JSON results path (default: benchmarks/results/hot_paths-<commit>.json)")
+    parser.add_argument("--compare", help="previous results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    report = run(args.app_dir, args.repeats, args.min_time, args.only)
+    print(f"{'case':<48}{'median':>14}{'best':>14}")
+    for name, r in report["results"].items():
+        print(f"{name:<48}{r['median_ns']:>12.0f}ns{r['best_ns']:>12.0f}ns")
+
+    output = args.output or os.path.join(ROOT, "benchmarks", "results",
+                                         f"hot_paths-{report['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nresults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
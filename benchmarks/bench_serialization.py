@@ -0,0 +1,82 @@
+"""
+Compares stdlib json with the orjson-based serialization module on the hot paths:
+one `streaming` frame per token and the history records written to / read from Redis.
+
+Run offline from the repository root:
+
+    python benchmarks/bench_serialization.py [--app-dir Production-Chatbot] [--iterations 200000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_DELTA = "Almonds are rich in monounsaturated fats, "
+SAMPLE_MESSAGE_ID = "msg_01XFDUDYJgAACzvnptvVoYEL"
+SAMPLE_RECORD = {
+    "role": "assistant",
+    "content": "<div><p>Almonds are a good choice for cholesterol management…</p></div>" * 4,
+}
+
+
+def cpu_ns_per_op(fn, iterations):
+    start = time.process_time_ns()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time_ns() - start) / iterations
+
+
+def run(iterations):
+    from serialization import FrameTemplate, dumps, loads
+
+    template = FrameTemplate("streaming", SAMPLE_MESSAGE_ID)
+    encoded_record = json.dumps(SAMPLE_RECORD)
+
+    cases = {
+        "frame_per_token": (
+            lambda: json.dumps({"message_id": SAMPLE_MESSAGE_ID, "type": "streaming", "data": SAMPLE_DELTA}),
+            lambda: template.render(SAMPLE_DELTA),
+        ),
+        "history_record_encode": (
+            lambda: json.dumps(SAMPLE_RECORD),
+            lambda: dumps(SAMPLE_RECORD),
+        ),
+        "history_record_decode": (
+            lambda: json.loads(encoded_record),
+            lambda: loads(encoded_record),
+        ),
+    }
+    results = {}
+    for name, (baseline, candidate) in cases.items():
+        baseline_ns = cpu_ns_per_op(baseline, iterations)
+        candidate_ns = cpu_ns_per_op(candidate, iterations)
+        results[name] = {
+            "stdlib_json_ns": round(baseline_ns, 1),
+            "serialization_ns": round(candidate_ns, 1),
+            "saved_ns_per_op": round(baseline_ns - candidate_ns, 1),
+            "speedup": round(baseline_ns / candidate_ns, 2) if candidate_ns else None,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app-dir", default="Production-Chatbot", help="service directory to import from")
+    parser.add_argument("--iterations", type=int, default=200_000)
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.join(ROOT, args.app_dir))
+
+    results = run(args.iterations)
+    print(f"{'case':<24}{'stdlib json':>14}{'serialization':>16}{'saved/op':>12}{'speedup':>10}")
+    for name, r in results.items():
+        print(f"{name:<24}{r['stdlib_json_ns']:>12.0f}ns{r['serialization_ns']:>14.0f}ns"
+              f"{r['saved_ns_per_op']:>10.0f}ns{r['speedup']:>9}x")
+    saved = results["frame_per_token"]["saved_ns_per_op"]
+    print(f"\nCPU saved per streamed token: {saved:.0f} ns ({saved * 1000 / 1e6:.2f} ms per 1000 tokens)")
+
+
+if __name__ == "__main__":
+    main()
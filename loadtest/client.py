@@ -0,0 +1,120 @@
+"""
+Simulated chat users: start_session -> N messages over the WebSocket -> end_session.
+
+For every message the client records time to first token (first `streaming` frame), time to
+message_stop, and how the message ended (ok, error frame, rate limited, shed, timeout).
+"""
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+
+import httpx
+import websockets
+
+QUESTIONS = (
+    "Can I eat peanuts with my profile?",
+    "What is a good high-fibre breakfast?",
+    "Is salmon a good choice for my cholesterol goal?",
+    "How much protein should I aim for at lunch?",
+    "Suggest a snack under 200 kcal.",
+)
+
+
+@dataclass
+class RunResults:
+    ttft_ms: list = field(default_factory=list)
+    total_ms: list = field(default_factory=list)
+    outcomes: dict = field(default_factory=dict)
+    frames: int = 0
+    session_errors: int = 0
+    started: float = 0.0
+    finished: float = 0.0
+
+    def count(self, outcome):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 1)
+
+
+async def send_message(ws, text, results: RunResults, timeout: float):
+    sent_at = time.perf_counter()
+    first_token = None
+    await ws.send(text)
+    try:
+        while True:
+            frame = json.loads(await asyncio.wait_for(ws.recv(), timeout=timeout))
+            results.frames += 1
+            kind = frame.get("type")
+            if kind == "streaming" and first_token is None:
+                first_token = time.perf_counter()
+                results.ttft_ms.append((first_token - sent_at) * 1000)
+            elif kind == "message_stop":
+                results.total_ms.append((time.perf_counter() - sent_at) * 1000)
+                results.count("ok")
+                return
+            elif kind == "error":
+                results.count("rate_limited_or_shed" if "retry_after" in frame else "error")
+                return
+    except asyncio.TimeoutError:
+        results.count("timeout")
+
+
+async def simulate_user(base_url, ws_base_url, api_key, user_id, messages, think_time, timeout,
+                        results: RunResults):
+    headers = {"Authorization": f"Bearer {api_key}"}
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as http:
+        response = await http.post("/chat/start_session", headers=headers,
+                                   json={"user_id": user_id, "user_name": user_id})
+        if response.status_code != 200:
+            results.session_errors += 1
+            return
+        try:
+            async with websockets.connect(f"{ws_base_url}/ws/{user_id}",
+                                          additional_headers=headers, open_timeout=timeout) as ws:
+                for _ in range(messages):
+                    await send_message(ws, random.choice(QUESTIONS), results, timeout)
+                    if think_time:
+                        await asyncio.sleep(random.uniform(0, 2 * think_time))
+        except (OSError, websockets.WebSocketException):
+            results.count("connection_error")
+        finally:
+            await http.post("/chat/end_session", json={"user_id": user_id})
+
+
+async def run_users(base_url, api_key, users, messages, think_time=0.0, ramp_up=0.0, timeout=60.0):
+    """Runs `users` concurrent simulated users, started evenly over `ramp_up` seconds."""
+    ws_base_url = base_url.replace("http://", "ws://").replace("https://", "wss://")
+    results = RunResults(started=time.perf_counter())
+
+    async def delayed(i):
+        await asyncio.sleep(ramp_up * i / max(users, 1))
+        await simulate_user(base_url, ws_base_url, api_key, f"loadtest-{i}", messages, think_time, timeout,
+                            results)
+
+    await asyncio.gather(*(delayed(i) for i in range(users)))
+    results.finished = time.perf_counter()
+    return results
+
+
+def summarize(results: RunResults) -> dict:
+    elapsed = max(results.finished - results.started, 1e-9)
+    total = sum(results.outcomes.values())
+    ok = results.outcomes.get("ok", 0)
+    return {
+        "messages": total,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_msgs_per_s": round(ok / elapsed, 2),
+        "frames_per_s": round(results.frames / elapsed, 1),
+        "error_rate": round((total - ok) / total, 4) if total else 0.0,
+        "outcomes": results.outcomes,
+        "session_errors": results.session_errors,
+        "ttft_ms": {f"p{p}": percentile(results.ttft_ms, p) for p in (50, 95, 99)},
+        "total_ms": {f"p{p}": percentile(results.total_ms, p) for p in (50, 95, 99)},
+    }
@@ -0,0 +1,192 @@
+"""
+Local stand-ins for every HTTP upstream the chatbot calls, served by one FastAPI app:
+
+    POST /anthropic/v1/messages       Anthropic Messages API, streamed as SSE
+    POST /grok/chat/completions       OpenAI-compatible chat completions (Grok), streamed as SSE
+    POST /opensearch                  OpenSearch profile search
+    POST /vectors                     Vector store query
+
+Each upstream has an UpstreamProfile: time to first token (or response latency), token rate,
+answer length and injected failures, both before the response (HTTP error) and mid-stream
+(connection dropped after some tokens).
+"""
+import asyncio
+import json
+import random
+import uuid
+from dataclasses import dataclass
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ("almonds", "oats", "fibre", "lentils", "salmon", "olive", "oil", "cholesterol", "portion",
+         "daily", "target", "protein", "spinach", "walnuts", "beans", "balanced", "meal", "snack")
+
+
+@dataclass
+class UpstreamProfile:
+    ttft_ms: float = 600.0
+    tokens_per_sec: float = 80.0
+    tokens: int = 300
+    error_rate: float = 0.0           # fraction of requests answered with error_status
+    error_status: int = 529
+    midstream_error_rate: float = 0.0  # fraction of streams cut after half the tokens
+    latency_ms: float = 20.0          # for the non-streaming upstreams
+    jitter: float = 0.2               # +/- fraction applied to every delay
+
+
+def _jittered(profile: UpstreamProfile, seconds: float) -> float:
+    return max(0.0, seconds * random.uniform(1 - profile.jitter, 1 + profile.jitter))
+
+
+def _tokens(count: int):
+    for i in range(count):
+        yield ("" if i == 0 else " ") + random.choice(WORDS)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class MidStreamFailure(Exception):
+    pass
+
+
+def create_app(profiles: dict, stats: dict) -> FastAPI:
+    """`profiles` maps claude/grok/opensearch/vectors to an UpstreamProfile; `stats` counts requests."""
+    app = FastAPI()
+
+    def count(name, outcome):
+        stats.setdefault(name, {}).setdefault(outcome, 0)
+        stats[name][outcome] += 1
+
+    async def stream_tokens(profile):
+        await asyncio.sleep(_jittered(profile, profile.ttft_ms / 1000))
+        cut_at = profile.tokens // 2 if random.random() < profile.midstream_error_rate else None
+        for i, token in enumerate(_tokens(profile.tokens)):
+            if i == cut_at:
+                raise MidStreamFailure()
+            if i:
+                await asyncio.sleep(_jittered(profile, 1 / profile.tokens_per_sec))
+            yield token
+
+    @app.post("/anthropic/v1/messages")
+    async def anthropic_messages(request: Request):
+        profile = profiles["claude"]
+        body = await request.json()
+        if random.random() < profile.error_rate:
+            count("claude", "error")
+            return JSONResponse(status_code=profile.error_status, content={
+                "type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}})
+        count("claude", "ok")
+        message_id = f"msg_{uuid.uuid4().hex[:24]}"
+        input_tokens = len(json.dumps(body)) // 4
+
+        async def events():
+            yield _sse("message_start", {"type": "message_start", "message": {
+                "id": message_id, "type": "message", "role": "assistant", "model": body.get("model"),
+                "content": [], "stop_reason": None, "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": 1,
+                          "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}}})
+            yield _sse("content_block_start", {"type": "content_block_start", "index": 0,
+                                               "content_block": {"type": "text", "text": ""}})
+            produced = 0
+            try:
+                async for token in stream_tokens(profile):
+                    produced += 1
+                    yield _sse("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                       "delta": {"type": "text_delta", "text": token}})
+            except MidStreamFailure:
+                count("claude", "midstream_error")
+                yield _sse("error", {"type": "error", "error": {"type": "overloaded_error",
+                                                                 "message": "Overloaded"}})
+                return
+            yield _sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+            yield _sse("message_delta", {"type": "message_delta",
+                                         "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                         "usage": {"output_tokens": produced}})
+            yield _sse("message_stop", {"type": "message_stop"})
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/grok/chat/completions")
+    async def grok_completions(request: Request):
+        profile = profiles["grok"]
+        body = await request.json()
+        if random.random() < profile.error_rate:
+            count("grok", "error")
+            return JSONResponse(status_code=profile.error_status, content={
+                "error": {"message": "Service overloaded", "type": "server_error"}})
+        count("grok", "ok")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+
+        def chunk(delta=None, usage=None):
+            return "data: " + json.dumps({
+                "id": completion_id, "object": "chat.completion.chunk", "created": 0,
+                "model": body.get("model"),
+                "choices": [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": None}],
+                "usage": usage,
+            }) + "\n\n"
+
+        async def events():
+            yield chunk({"role": "assistant", "content": ""})
+            produced = 0
+            try:
+                async for token in stream_tokens(profile):
+                    produced += 1
+                    yield chunk({"content": token})
+            except MidStreamFailure:
+                count("grok", "midstream_error")
+                return  # the client sees the stream end without a usage packet or [DONE]
+            yield chunk(usage={"prompt_tokens": len(json.dumps(body)) // 4, "completion_tokens": produced,
+                               "total_tokens": produced,
+                               "completion_tokens_details": {"reasoning_tokens": 0}})
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/opensearch")
+    async def opensearch(request: Request):
+        profile = profiles["opensearch"]
+        body = await request.json()
+        await asyncio.sleep(_jittered(profile, profile.latency_ms / 1000))
+        if random.random() < profile.error_rate:
+            count("opensearch", "error")
+            return JSONResponse(status_code=503, content={"error": "unavailable"})
+        count("opensearch", "ok")
+        user_id = body.get("query", {}).get("match", {}).get("foodhak_user_id", "unknown")
+        return {"hits": {"total": {"value": 1}, "hits": [{"_source": fake_profile(user_id)}]}}
+
+    @app.post("/vectors")
+    async def vectors(request: Request):
+        profile = profiles["vectors"]
+        await request.body()
+        await asyncio.sleep(_jittered(profile, profile.latency_ms / 1000))
+        if random.random() < profile.error_rate:
+            count("vectors", "error")
+            return JSONResponse(status_code=503, content={"error": "unavailable"})
+        count("vectors", "ok")
+        return {"results": [{"queries": [], "results": [
+            {"text": " ".join(random.choice(WORDS) for _ in range(40)), "score": round(random.random(), 3)}
+            for _ in range(10)]}]}
+
+    return app
+
+
+def fake_profile(user_id: str) -> dict:
+    return {
+        "foodhak_user_id": user_id,
+        "name": f"Load Test {user_id}",
+        "age": 35,
+        "sex": "female",
+        "height": 168,
+        "weight": 64,
+        "ethnicity": {"title": "Not specified"},
+        "user_health_goals": [{"user_goal": {"title": "Lower cholesterol", "is_primary": True}}],
+        "dietary_preferences": [],
+        "allergens": [],
+        "nutrients": {"results": {"micro": [
+            {"nutrition_guideline": {"item": "Energy"}, "target_value": 2000},
+            {"nutrition_guideline": {"item": "Protein"}, "target_value": 60},
+        ]}},
+    }
@@ -0,0 +1,183 @@
+"""
+Offline load test: runs the chatbot in-process against local stand-ins for Anthropic, Grok,
+OpenSearch and the vector store (fake_upstreams.py) and an in-memory Redis (fakeredis), then
+drives it with simulated users (client.py) and reports TTFT percentiles, throughput and errors.
+
+Run from the repository root (extra dependencies: loadtest/requirements.txt):
+
+    python loadtest/run.py --users 50 --messages 3
+    python loadtest/run.py --users 200 --claude ttft_ms=2500,error_rate=0.05 --grok ttft_ms=900
+    HEDGE_ENABLED=true python loadtest/run.py --claude midstream_error_rate=0.2 --json results.json
+
+Upstream profiles are comma-separated UpstreamProfile fields. Chatbot settings (HEDGE_*,
+ADMISSION_*, BREAKER_*, ...) are read from the environment as usually; rate limiting is off
+unless RATE_LIMIT_ENABLED is set, since every simulated user shares one machine.
+--redis-url points the service at a real standalone Redis instead of fakeredis.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from dataclasses import fields
+
+import uvicorn
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from client import run_users, summarize  # noqa: E402
+from fake_upstreams import UpstreamProfile, create_app  # noqa: E402
+
+API_KEY = "loadtest-key"
+
+DEFAULT_PROFILES = {
+    "claude": "ttft_ms=700,tokens_per_sec=80,tokens=300",
+    "grok": "ttft_ms=500,tokens_per_sec=120,tokens=300",
+    "opensearch": "latency_ms=25",
+    "vectors": "latency_ms=60",
+}
+
+
+def parse_profile(spec: str) -> UpstreamProfile:
+    types = {f.name: f.type for f in fields(UpstreamProfile)}
+    values = {}
+    for item in filter(None, spec.split(",")):
+        name, _, value = item.partition("=")
+        if name not in types:
+            raise argparse.ArgumentTypeError(f"unknown upstream setting '{name}' (one of {', '.join(types)})")
+        values[name] = int(value) if types[name] in (int, "int") else float(value)
+    return UpstreamProfile(**values)
+
+
+def configure_environment(upstream_url: str):
+    # Both services' variable names are set so either app dir can be tested
+    env = {
+        "ANTHROPIC_BASE_URL": f"{upstream_url}/anthropic",
+        "PRODUCTION_GROK_URL": f"{upstream_url}/grok",
+        "STAGING_GROK_URL": f"{upstream_url}/grok",
+        "OPENSEARCH_HOST": f"{upstream_url}/opensearch",
+        "STAGING_OPENSEARCH_HOST": f"{upstream_url}/opensearch",
+        "VECTOR_STORE_URL": f"{upstream_url}/vectors",
+        "API_KEY": API_KEY,
+        "STAGING_API_KEY": API_KEY,
+    }
+    for name in ("ANTHROPIC_PRODUCTION_API_KEY", "ANTHROPIC_STAGING_API_KEY", "PRODUCTION_GROK_API_KEY",
+                 "STAGING_GROK_API_KEY", "OPENSEARCH_USER", "OPENSEARCH_PWD", "STAGING_OPENSEARCH_USER",
+                 "STAGING_OPENSEARCH_PWD"):
+        env[name] = "loadtest"
+    os.environ.update(env)
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+
+def use_redis_stand_in(main, redis_url=None):
+    """Points the service's Redis clients at fakeredis (shared in-memory server) or a standalone Redis."""
+    if redis_url:
+        from redis.asyncio import Redis
+
+        def connect():
+            return Redis.from_url(redis_url, decode_responses=True)
+    else:
+        import fakeredis
+
+        server = fakeredis.FakeServer()
+
+        def connect():
+            return fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+
+    main.redis_client = connect()
+    main.get_pubsub_connection = connect
+
+
+async def serve(app, port, log_level):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level=log_level,
+                                           ws_max_size=16 * 1024 * 1024))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+async def run(args):
+    profiles = {name: getattr(args, name) for name in DEFAULT_PROFILES}
+    upstream_stats = {}
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    upstreams, upstreams_task = await serve(create_app(profiles, upstream_stats), args.upstream_port, "warning")
+
+    configure_environment(upstream_url)
+    sys.path.insert(0, os.path.join(ROOT, args.app_dir))
+    import main  # noqa: E402 - imported after the environment points at the stand-ins
+
+    logging.getLogger().setLevel(args.log_level.upper())
+    use_redis_stand_in(main, args.redis_url)
+    app_server, app_task = await serve(main.app, args.port, args.log_level)
+
+    try:
+        results = await run_users(f"http://127.0.0.1:{args.port}", API_KEY, args.users, args.messages,
+                                  think_time=args.think_time, ramp_up=args.ramp_up, timeout=args.timeout)
+    finally:
+        app_server.should_exit = True
+        upstreams.should_exit = True
+        await asyncio.gather(app_task, upstreams_task, return_exceptions=True)
+
+    summary = summarize(results)
+    summary["config"] = {
+        "app_dir": args.app_dir, "users": args.users, "messages_per_user": args.messages,
+        "think_time_s": args.think_time, "ramp_up_s": args.ramp_up,
+        "upstreams": {name: vars(profile) for name, profile in profiles.items()},
+    }
+    summary["upstream_requests"] = upstream_stats
+    summary["service"] = {
+        "hedging": main.get_hedge_stats(),
+        "providers": main.provider_router.snapshot(),
+        "admission": main.admission.snapshot(),
+        "failovers": main.stream_stats["failovers"],
+    }
+    return summary
+
+
+def print_report(summary):
+    print(f"\n{summary['messages']} messages in {summary['elapsed_s']} s "
+          f"({summary['config']['users']} users x {summary['config']['messages_per_user']})")
+    print(f"throughput: {summary['throughput_msgs_per_s']} msgs/s, {summary['frames_per_s']} frames/s")
+    print(f"error rate: {summary['error_rate']:.2%}  outcomes: {summary['outcomes']}"
+          f"  session errors: {summary['session_errors']}")
+    for metric in ("ttft_ms", "total_ms"):
+        values = summary[metric]
+        print(f"{metric:<9} p50={values['p50']}  p95={values['p95']}  p99={values['p99']}")
+    print(f"upstream requests: {summary['upstream_requests']}")
+    print(f"hedged: {summary['service']['hedging']['hedged']}, failovers: {summary['service']['failovers']}, "
+          f"fallbacks: {summary['service']['providers']['fallbacks']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app-dir", default="Production-Chatbot", help="service directory to import from")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=3, help="messages per user")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean pause between messages (s)")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="seconds over which users connect")
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-frame receive timeout (s)")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--upstream-port", type=int, default=18001)
+    parser.add_argument("--redis-url", help="standalone Redis to use instead of fakeredis")
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--json", help="also write the results to this file")
+    for name, default in DEFAULT_PROFILES.items():
+        parser.add_argument(f"--{name}", type=parse_profile, default=parse_profile(default),
+                            help=f"upstream profile (default: {default})")
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()